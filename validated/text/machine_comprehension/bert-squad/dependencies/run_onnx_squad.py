@@ -31,11 +31,15 @@ python onnx_squad.py --model $SQUAD_MODEL/squad.onnx \
 
 import argparse
 import collections
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import hashlib
 import json
 import logging
-import math
 import os
+import queue
+import shutil
 import sys
+import threading
 from timeit import default_timer as timer
 
 import numpy as np
@@ -46,8 +50,57 @@ import tokenization
 
 RawResult = collections.namedtuple("RawResult", ["unique_id", "start_logits", "end_logits"])
 
-Feature = collections.namedtuple("Feature", ["unique_id", "tokens", "example_index",
-                                             "token_to_orig_map", "token_is_max_context"])
+
+class FeatureStore(object):
+    """Columnar storage of the features needed to write the predictions.
+
+    The tokens (as vocab ids), the map from token to original doc token and the
+    max context flags of all features are concatenated into flat arrays. The
+    tokens of feature i, whose unique_id is i, are token_offsets[i]:token_offsets[i + 1].
+    token_to_orig is -1 for tokens which are not part of the doc span.
+    """
+
+    def __init__(self, example_index, token_offsets, token_ids, token_to_orig, token_is_max_context, inv_vocab):
+        self.example_index = example_index
+        self.token_offsets = token_offsets
+        self.token_ids = token_ids
+        self.token_to_orig = token_to_orig
+        self.token_is_max_context = token_is_max_context
+        self.inv_vocab = inv_vocab
+
+    @classmethod
+    def allocate(cls, num_features, num_tokens, inv_vocab):
+        return cls(np.zeros(num_features, dtype=np.int32),
+                   np.zeros(num_features + 1, dtype=np.int64),
+                   np.zeros(num_tokens, dtype=np.int32),
+                   np.full(num_tokens, -1, dtype=np.int32),
+                   np.zeros(num_tokens, dtype=bool),
+                   inv_vocab)
+
+    @classmethod
+    def concatenate(cls, stores, example_starts, inv_vocab):
+        """Merge stores of consecutive shards, whose examples start at example_starts."""
+        token_starts = np.cumsum([0] + [len(store.token_ids) for store in stores])
+        return cls(np.concatenate([store.example_index + example_start
+                                   for store, example_start in zip(stores, example_starts)]),
+                   np.concatenate([[0]] + [store.token_offsets[1:] + token_start
+                                           for store, token_start in zip(stores, token_starts)]),
+                   np.concatenate([store.token_ids for store in stores]),
+                   np.concatenate([store.token_to_orig for store in stores]),
+                   np.concatenate([store.token_is_max_context for store in stores]),
+                   inv_vocab)
+
+    def __len__(self):
+        return len(self.example_index)
+
+    def get_span(self, unique_id):
+        return self.token_offsets[unique_id], self.token_offsets[unique_id + 1]
+
+    def get_tokens(self, unique_id, start_index, end_index):
+        """Return the tokens start_index..end_index (inclusive) of a feature."""
+        offset = self.token_offsets[unique_id]
+        token_ids = self.token_ids[offset + start_index:offset + end_index + 1]
+        return [self.inv_vocab[token_id] for token_id in token_ids.tolist()]
 
 
 class SquadExample(object):
@@ -82,8 +135,8 @@ class SquadExample(object):
         return ", ".join(s)
 
 
-def _check_is_max_context(doc_spans, cur_span_index, position):
-    """Check if this is the 'max context' doc span for the token."""
+def _get_max_context_span_index(doc_spans, num_tokens):
+    """Return, for each doc token, the index of its 'max context' doc span."""
 
     # Because of the sliding window approach taken to scoring documents, a single
     # token can appear in multiple documents. E.g.
@@ -101,58 +154,52 @@ def _check_is_max_context(doc_spans, cur_span_index, position):
     # In the example the maximum context for 'bought' would be span C since
     # it has 1 left context and 3 right context, while span B has 4 left context
     # and 0 right context.
-    best_score = None
-    best_span_index = None
+    #
+    # All spans are scored in one pass over them, instead of rescanning all spans
+    # for every token of every span. Ties go to the first span.
+    best_scores = np.full(num_tokens, -np.inf)
+    best_span_index = np.zeros(num_tokens, dtype=np.int32)
     for (span_index, doc_span) in enumerate(doc_spans):
-        end = doc_span.start + doc_span.length - 1
-        if position < doc_span.start:
-            continue
-        if position > end:
-            continue
-        num_left_context = position - doc_span.start
-        num_right_context = end - position
-        score = min(num_left_context, num_right_context) + 0.01 * doc_span.length
-        if best_score is None or score > best_score:
-            best_score = score
-            best_span_index = span_index
-
-    return cur_span_index == best_span_index
+        num_left_context = np.arange(doc_span.length)
+        num_right_context = num_left_context[::-1]
+        scores = np.minimum(num_left_context, num_right_context) + 0.01 * doc_span.length
+        end = doc_span.start + doc_span.length
+        is_better = scores > best_scores[doc_span.start:end]
+        best_scores[doc_span.start:end][is_better] = scores[is_better]
+        best_span_index[doc_span.start:end][is_better] = span_index
+    return best_span_index
 
 
 def convert_examples_to_features(examples, tokenizer, max_seq_length, doc_stride, max_query_length):
     """Loads a data file into a list of `InputBatch`s."""
 
-    res_input_ids = []
-    res_input_mask = []
-    res_segment_ids = []
-    extra = []
-    unique_id = 0
+    _DocSpan = collections.namedtuple("DocSpan", ["start", "length"])
 
-    for (example_index, example) in enumerate(examples):
+    # First tokenize everything to know the number of features, so that the id
+    # arrays can be allocated once and filled in place.
+    tokenized_examples = []
+    num_features = 0
+    num_tokens = 0
+    for example in examples:
         query_tokens = tokenizer.tokenize(example.question_text)
 
         if len(query_tokens) > max_query_length:
             query_tokens = query_tokens[0:max_query_length]
 
         tok_to_orig_index = []
-        orig_to_tok_index = []
         all_doc_tokens = []
         for (i, token) in enumerate(example.doc_tokens):
-            orig_to_tok_index.append(len(all_doc_tokens))
             sub_tokens = tokenizer.tokenize(token)
             for sub_token in sub_tokens:
                 tok_to_orig_index.append(i)
                 all_doc_tokens.append(sub_token)
 
-        tok_start_position = None
-        tok_end_position = None
         # The -3 accounts for [CLS], [SEP] and [SEP]
         max_tokens_for_doc = max_seq_length - len(query_tokens) - 3
 
         # We can have documents that are longer than the maximum sequence length.
         # To deal with this we do a sliding window approach, where we take chunks
         # of the up to our max length with a stride of `doc_stride`.
-        _DocSpan = collections.namedtuple("DocSpan", ["start", "length"])
         doc_spans = []
         start_offset = 0
         while start_offset < len(all_doc_tokens):
@@ -164,51 +211,166 @@ def convert_examples_to_features(examples, tokenizer, max_seq_length, doc_stride
                 break
             start_offset += min(length, doc_stride)
 
+        tokenized_examples.append((query_tokens, all_doc_tokens, tok_to_orig_index, doc_spans))
+        num_features += len(doc_spans)
+        num_tokens += sum(len(query_tokens) + 3 + doc_span.length for doc_span in doc_spans)
+
+    extra = FeatureStore.allocate(num_features, num_tokens, tokenizer.inv_vocab)
+    # every feature is [CLS] query [SEP] doc span [SEP]
+    feature_query_ids = []
+    feature_doc_ids = []
+    unique_id = 0
+    offset = 0
+
+    for (example_index, (query_tokens, all_doc_tokens, tok_to_orig_index, doc_spans)) in \
+            enumerate(tokenized_examples):
+        query_ids = tokenizer.convert_tokens_to_ids(query_tokens)
+        max_context_span_index = _get_max_context_span_index(doc_spans, len(all_doc_tokens))
+        all_doc_ids = np.array(tokenizer.convert_tokens_to_ids(all_doc_tokens), dtype=np.int64)
+        tok_to_orig_index = np.array(tok_to_orig_index, dtype=np.int32)
+        doc_offset = len(query_tokens) + 2
+
         for (doc_span_index, doc_span) in enumerate(doc_spans):
-            tokens = []
-            token_to_orig_map = {}
-            token_is_max_context = {}
-            segment_ids = []
-            tokens.append("[CLS]")
-            segment_ids.append(0)
-            for token in query_tokens:
-                tokens.append(token)
-                segment_ids.append(0)
-            tokens.append("[SEP]")
-            segment_ids.append(0)
-
-            for i in range(doc_span.length):
-                split_token_index = doc_span.start + i
-                token_to_orig_map[len(tokens)] = tok_to_orig_index[split_token_index]
-
-                is_max_context = _check_is_max_context(doc_spans, doc_span_index,
-                                                       split_token_index)
-                token_is_max_context[len(tokens)] = is_max_context
-                tokens.append(all_doc_tokens[split_token_index])
-                segment_ids.append(1)
-            tokens.append("[SEP]")
-            segment_ids.append(1)
-
-            input_ids = tokenizer.convert_tokens_to_ids(tokens)
-
-            # The mask has 1 for real tokens and 0 for padding tokens. Only real
-            # tokens are attended to.
-            input_mask = [1] * len(input_ids)
-
-            # Zero-pad up to the sequence length.
-            while len(input_ids) < max_seq_length:
-                input_ids.append(0)
-                input_mask.append(0)
-                segment_ids.append(0)
-            res_input_ids.append(np.array(input_ids, dtype=np.int64))
-            res_input_mask.append(np.array(input_mask, dtype=np.int64))
-            res_segment_ids.append(np.array(segment_ids, dtype=np.int64))
-            feature = Feature(unique_id=unique_id, tokens=tokens,
-                              example_index=example_index, token_to_orig_map=token_to_orig_map,
-                              token_is_max_context=token_is_max_context)
-            extra.append(feature)
+            seq_length = doc_offset + doc_span.length + 1
+            doc_span_end = doc_span.start + doc_span.length
+            feature_query_ids.append(query_ids)
+            feature_doc_ids.append(all_doc_ids[doc_span.start:doc_span_end])
+
+            # Only the doc tokens map to an original token and can have max context.
+            doc_start = offset + doc_offset
+            doc_end = doc_start + doc_span.length
+            extra.example_index[unique_id] = example_index
+            extra.token_to_orig[doc_start:doc_end] = tok_to_orig_index[doc_span.start:doc_span_end]
+            extra.token_is_max_context[doc_start:doc_end] = \
+                max_context_span_index[doc_span.start:doc_span_end] == doc_span_index
+            offset += seq_length
             unique_id += 1
-    return np.array(res_input_ids), np.array(res_input_mask), np.array(res_segment_ids), extra
+            extra.token_offsets[unique_id] = offset
+
+    # The mask has 1 for real tokens and 0 for padding tokens. Only real tokens are
+    # attended to. The spans fit max_seq_length, so nothing is truncated.
+    res_input_ids, res_input_mask, res_segment_ids = tokenizer.encode_ids_batch(
+        feature_query_ids, max_seq_length, feature_doc_ids)
+    # The tokens of the features are their input ids up to the padding, one after the other.
+    extra.token_ids[:] = res_input_ids[res_input_mask == 1]
+    return res_input_ids, res_input_mask, res_segment_ids, extra
+
+
+# tokenizer of the current feature conversion worker, set up by _init_feature_worker
+_worker_tokenizer = None
+
+
+def _init_feature_worker(tokenizer):
+    global _worker_tokenizer
+    _worker_tokenizer = tokenizer
+
+
+def _convert_shard(examples, max_seq_length, doc_stride, max_query_length):
+    result = convert_examples_to_features(examples, _worker_tokenizer, max_seq_length, doc_stride, max_query_length)
+    # the parent has the vocab already, don't send it back with every shard
+    result[3].inv_vocab = None
+    return result
+
+
+def convert_examples_to_features_parallel(examples, tokenizer, max_seq_length, doc_stride, max_query_length,
+                                          num_workers):
+    """Same as convert_examples_to_features, but converts shards of the examples on a process pool."""
+    if num_workers <= 1 or len(examples) < 2:
+        return convert_examples_to_features(examples, tokenizer, max_seq_length, doc_stride, max_query_length)
+
+    # a few shards per worker even out the differences in document length
+    num_shards = min(len(examples), num_workers * 4)
+    shard_size = (len(examples) + num_shards - 1) // num_shards
+    shard_starts = list(range(0, len(examples), shard_size))
+    shards = [examples[start:start + shard_size] for start in shard_starts]
+
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_feature_worker,
+                             initargs=(tokenizer,)) as executor:
+        results = list(executor.map(_convert_shard, shards, [max_seq_length] * len(shards),
+                                    [doc_stride] * len(shards), [max_query_length] * len(shards)))
+
+    # shards number their examples and features from 0, shift them to their global position
+    extra = FeatureStore.concatenate([result[3] for result in results], shard_starts, tokenizer.inv_vocab)
+    input_ids = np.concatenate([result[0] for result in results])
+    input_mask = np.concatenate([result[1] for result in results])
+    segment_ids = np.concatenate([result[2] for result in results])
+    return input_ids, input_mask, segment_ids, extra
+
+
+# bump when the cached arrays or their meaning change, so that old caches are not used
+FEATURE_CACHE_VERSION = 2
+_FEATURE_CACHE_ARRAYS = ["input_ids", "input_mask", "segment_ids", "example_index", "token_offsets",
+                         "token_ids", "token_to_orig", "token_is_max_context"]
+
+
+def get_feature_cache_key(predict_file, vocab_file, max_seq_length, doc_stride, max_query_length):
+    """Hash of everything the converted features depend on."""
+    key = hashlib.sha256()
+    for path in [predict_file, vocab_file]:
+        file_hash = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                file_hash.update(chunk)
+        key.update(file_hash.digest())
+    key.update(json.dumps([FEATURE_CACHE_VERSION, max_seq_length, doc_stride, max_query_length]).encode())
+    return key.hexdigest()
+
+
+def save_feature_cache(cache_dir, key, examples, input_ids, input_mask, segment_ids, extra_data):
+    """Store examples and features in cache_dir/key as .npy files and a metadata.json."""
+    path = os.path.join(cache_dir, key)
+    tmp_path = "{}.tmp{}".format(path, os.getpid())
+    os.makedirs(tmp_path, exist_ok=True)
+    arrays = {"input_ids": input_ids, "input_mask": input_mask, "segment_ids": segment_ids,
+              "example_index": extra_data.example_index, "token_offsets": extra_data.token_offsets,
+              "token_ids": extra_data.token_ids, "token_to_orig": extra_data.token_to_orig,
+              "token_is_max_context": extra_data.token_is_max_context}
+    for name in _FEATURE_CACHE_ARRAYS:
+        np.save(os.path.join(tmp_path, name + ".npy"), arrays[name])
+    # the examples of a paragraph share its doc_tokens (see read_squad_examples), store each paragraph once
+    paragraphs = []
+    paragraph_index = {}
+    metadata_examples = []
+    for example in examples:
+        if id(example.doc_tokens) not in paragraph_index:
+            paragraph_index[id(example.doc_tokens)] = len(paragraphs)
+            paragraphs.append(example.doc_tokens)
+        metadata_examples.append([example.qas_id, example.question_text, paragraph_index[id(example.doc_tokens)]])
+    metadata = {
+        "version": FEATURE_CACHE_VERSION,
+        "num_features": len(input_ids),
+        "paragraphs": paragraphs,
+        "examples": metadata_examples,
+    }
+    with open(os.path.join(tmp_path, "metadata.json"), "w") as f:
+        json.dump(metadata, f)
+    # a concurrent run may have stored the same features meanwhile, keep the first one
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        shutil.rmtree(tmp_path)
+
+
+def load_feature_cache(cache_dir, key, inv_vocab):
+    """Load what save_feature_cache stored with the arrays memory mapped.
+
+    :return: examples, input_ids, input_mask, segment_ids and the FeatureStore, or None if nothing is cached
+    """
+    path = os.path.join(cache_dir, key)
+    metadata_file = os.path.join(path, "metadata.json")
+    if not os.path.exists(metadata_file):
+        return None
+    with open(metadata_file, "r") as f:
+        metadata = json.load(f)
+    if metadata["version"] != FEATURE_CACHE_VERSION:
+        return None
+    arrays = {name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r") for name in _FEATURE_CACHE_ARRAYS}
+    paragraphs = metadata["paragraphs"]
+    examples = [SquadExample(qas_id=qas_id, question_text=question_text, doc_tokens=paragraphs[paragraph])
+                for (qas_id, question_text, paragraph) in metadata["examples"]]
+    extra_data = FeatureStore(arrays["example_index"], arrays["token_offsets"], arrays["token_ids"],
+                              arrays["token_to_orig"], arrays["token_is_max_context"], inv_vocab)
+    return examples, arrays["input_ids"], arrays["input_mask"], arrays["segment_ids"], extra_data
 
 
 def read_squad_examples(input_file):
@@ -260,77 +422,89 @@ def write_predictions(all_examples, all_features, all_results, n_best_size,
                       max_answer_length, do_lower_case, output_prediction_file,
                       output_nbest_file):
     """Write final predictions to the json file."""
-    example_index_to_features = collections.defaultdict(list)
-    for feature in all_features:
-        example_index_to_features[feature.example_index].append(feature)
+    all_predictions, all_nbest_json = get_predictions(all_examples, all_features, all_results, n_best_size,
+                                                      max_answer_length, do_lower_case)
+    write_prediction_files(all_predictions, all_nbest_json, output_prediction_file, output_nbest_file)
+
 
+def write_prediction_files(all_predictions, all_nbest_json, output_prediction_file, output_nbest_file):
+    with open(output_prediction_file, "w") as writer:
+        writer.write(json.dumps(all_predictions, indent=4) + "\n")
+
+    with open(output_nbest_file, "w") as writer:
+        writer.write(json.dumps(all_nbest_json, indent=4) + "\n")
+
+
+def get_predictions(all_examples, all_features, all_results, n_best_size, max_answer_length, do_lower_case):
+    """Return the best prediction and the n-best list of every example, keyed by qas_id."""
     unique_id_to_result = {}
     for result in all_results:
         unique_id_to_result[result.unique_id] = result
 
-    _PrelimPrediction = collections.namedtuple(  # pylint: disable=invalid-name
-        "PrelimPrediction",
-        ["feature_index", "start_index", "end_index", "start_logit", "end_logit"])
-
-    all_predictions = collections.OrderedDict()
-    all_nbest_json = collections.OrderedDict()
+    # all_features is a FeatureStore, features are referred to by their unique_id.
+    # Features are ordered by example, so the rows of an example are contiguous.
+    unique_ids = []
+    for unique_id in range(len(all_features)):
+        if not unique_id in unique_id_to_result:
+            print("feature not in unique_Id", unique_id)
+            continue
+        unique_ids.append(unique_id)
+    if unique_ids:
+        start_logits = np.stack([unique_id_to_result[unique_id].start_logits for unique_id in unique_ids])
+        end_logits = np.stack([unique_id_to_result[unique_id].end_logits for unique_id in unique_ids])
+    else:
+        start_logits = end_logits = np.zeros((0, 0), dtype=np.float32)
+    unique_ids = np.array(unique_ids, dtype=np.int64)
+    example_bounds = np.searchsorted(all_features.example_index[unique_ids], np.arange(len(all_examples) + 1))
+
+    # The n-best start and end indexes of all features, and whether they can
+    # start or end an answer at all: they have to be in the doc span, and the
+    # start has to be in the span with its max context.
+    token_offsets = all_features.token_offsets[unique_ids][:, None]
+    num_tokens = all_features.token_offsets[unique_ids + 1][:, None] - token_offsets
+    start_indexes = _get_best_indexes(start_logits, n_best_size)
+    end_indexes = _get_best_indexes(end_logits, n_best_size)
+    start_positions = token_offsets + np.minimum(start_indexes, num_tokens - 1)
+    end_positions = token_offsets + np.minimum(end_indexes, num_tokens - 1)
+    start_is_valid = ((start_indexes < num_tokens) & (all_features.token_to_orig[start_positions] >= 0) &
+                      all_features.token_is_max_context[start_positions])
+    end_is_valid = (end_indexes < num_tokens) & (all_features.token_to_orig[end_positions] >= 0)
+    best_start_logits = np.take_along_axis(start_logits, start_indexes, axis=1)
+    best_end_logits = np.take_along_axis(end_logits, end_indexes, axis=1)
+
+    _NbestPrediction = collections.namedtuple(  # pylint: disable=invalid-name
+        "NbestPrediction", ["text", "start_logit", "end_logit"])
+
+    all_nbest = []
     for (example_index, example) in enumerate(all_examples):
-        features = example_index_to_features[example_index]
-        prelim_predictions = []
-        for (feature_index, feature) in enumerate(features):
-            if not feature.unique_id in unique_id_to_result:
-                print("feature not in unique_Id", feature.unique_id)
-                continue
-            result = unique_id_to_result[feature.unique_id]
-
-            start_indexes = _get_best_indexes(result.start_logits, n_best_size)
-            end_indexes = _get_best_indexes(result.end_logits, n_best_size)
-            for start_index in start_indexes:
-                for end_index in end_indexes:
-                    # We could hypothetically create invalid predictions, e.g., predict
-                    # that the start of the span is in the question. We throw out all
-                    # invalid predictions.
-                    if start_index >= len(feature.tokens):
-                        continue
-                    if end_index >= len(feature.tokens):
-                        continue
-                    if start_index not in feature.token_to_orig_map:
-                        continue
-                    if end_index not in feature.token_to_orig_map:
-                        continue
-                    if not feature.token_is_max_context.get(start_index, False):
-                        continue
-                    if end_index < start_index:
-                        continue
-                    length = end_index - start_index + 1
-                    if length > max_answer_length:
-                        continue
-                    prelim_predictions.append(
-                        _PrelimPrediction(
-                            feature_index=feature_index,
-                            start_index=start_index,
-                            end_index=end_index,
-                            start_logit=result.start_logits[start_index],
-                            end_logit=result.end_logits[end_index]))
-
-        prelim_predictions = sorted(
-            prelim_predictions,
-            key=lambda x: (x.start_logit + x.end_logit),
-            reverse=True)
-
-        _NbestPrediction = collections.namedtuple(  # pylint: disable=invalid-name
-            "NbestPrediction", ["text", "start_logit", "end_logit"])
+        rows = slice(example_bounds[example_index], example_bounds[example_index + 1])
+
+        # Score all n-best start x end pairs of the features of this example at
+        # once. We could hypothetically create invalid predictions, e.g., predict
+        # that the start of the span is in the question. We throw out all
+        # invalid predictions.
+        length = end_indexes[rows, None, :] - start_indexes[rows, :, None] + 1
+        is_valid = (start_is_valid[rows, :, None] & end_is_valid[rows, None, :] &
+                    (length >= 1) & (length <= max_answer_length))
+        scores = (best_start_logits[rows, :, None] + best_end_logits[rows, None, :]).ravel()
+        # candidates in feature, start rank, end rank order, then by score; the sort keeps that order for ties
+        candidates = np.flatnonzero(is_valid)
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
 
         seen_predictions = {}
         nbest = []
-        for pred in prelim_predictions:
+        for candidate in candidates.tolist():
             if len(nbest) >= n_best_size:
                 break
-            feature = features[pred.feature_index]
-
-            tok_tokens = feature.tokens[pred.start_index:(pred.end_index + 1)]
-            orig_doc_start = feature.token_to_orig_map[pred.start_index]
-            orig_doc_end = feature.token_to_orig_map[pred.end_index]
+            (row, start_rank, end_rank) = np.unravel_index(candidate, is_valid.shape)
+            row += rows.start
+            unique_id = unique_ids[row]
+            start_index = start_indexes[row, start_rank]
+            end_index = end_indexes[row, end_rank]
+
+            tok_tokens = all_features.get_tokens(unique_id, start_index, end_index)
+            orig_doc_start = int(all_features.token_to_orig[start_positions[row, start_rank]])
+            orig_doc_end = int(all_features.token_to_orig[end_positions[row, end_rank]])
             orig_tokens = example.doc_tokens[orig_doc_start:(orig_doc_end + 1)]
             tok_text = " ".join(tok_tokens)
 
@@ -351,8 +525,8 @@ def write_predictions(all_examples, all_features, all_results, n_best_size,
             nbest.append(
                 _NbestPrediction(
                     text=final_text,
-                    start_logit=pred.start_logit,
-                    end_logit=pred.end_logit))
+                    start_logit=best_start_logits[row, start_rank],
+                    end_logit=best_end_logits[row, end_rank]))
 
         # In very rare edge cases we could have no valid predictions. So we
         # just create a nonce prediction in this case to avoid failure.
@@ -361,30 +535,31 @@ def write_predictions(all_examples, all_features, all_results, n_best_size,
                 _NbestPrediction(text="empty", start_logit=0.0, end_logit=0.0))
 
         assert len(nbest) >= 1
+        all_nbest.append(nbest)
 
-        total_scores = []
-        for entry in nbest:
-            total_scores.append(entry.start_logit + entry.end_logit)
-
-        probs = _compute_softmax(total_scores)
+    # softmax over the n-best of every example in one go
+    nbest_sizes = [len(nbest) for nbest in all_nbest]
+    total_scores = np.array([entry.start_logit + entry.end_logit for nbest in all_nbest for entry in nbest],
+                            dtype=best_start_logits.dtype)
+    all_probs = _compute_softmax(total_scores, np.cumsum([0] + nbest_sizes[:-1]), nbest_sizes).tolist()
 
+    all_predictions = collections.OrderedDict()
+    all_nbest_json = collections.OrderedDict()
+    prob_index = 0
+    for (example, nbest) in zip(all_examples, all_nbest):
         nbest_json = []
-        for (i, entry) in enumerate(nbest):
+        for entry in nbest:
             output = collections.OrderedDict()
             output["text"] = entry.text
-            output["probability"] = probs[i]
+            output["probability"] = all_probs[prob_index]
             output["start_logit"] = float(entry.start_logit)
             output["end_logit"] = float(entry.end_logit)
             nbest_json.append(output)
+            prob_index += 1
 
         all_predictions[example.qas_id] = nbest_json[0]["text"]
         all_nbest_json[example.qas_id] = nbest_json
-
-    with open(output_prediction_file, "w") as writer:
-        writer.write(json.dumps(all_predictions, indent=4) + "\n")
-
-    with open(output_nbest_file, "w") as writer:
-        writer.write(json.dumps(all_nbest_json, indent=4) + "\n")
+    return all_predictions, all_nbest_json
 
 
 def get_final_text(pred_text, orig_text, do_lower_case):
@@ -474,37 +649,241 @@ def get_final_text(pred_text, orig_text, do_lower_case):
 
 
 def _get_best_indexes(logits, n_best_size):
-    """Get the n-best logits from a list."""
-    index_and_score = sorted(enumerate(logits), key=lambda x: x[1], reverse=True)
-    best_indexes = []
-    for i in range(len(index_and_score)):
-        if i >= n_best_size:
-            break
-        best_indexes.append(index_and_score[i][0])
-    return best_indexes
-
-
-def _compute_softmax(scores):
-    """Compute softmax probability over raw logits."""
-    if not scores:
-        return []
-
-    max_score = None
-    for score in scores:
-        if max_score is None or score > max_score:
-            max_score = score
-
-    exp_scores = []
-    total_sum = 0.0
-    for score in scores:
-        x = math.exp(score - max_score)
-        exp_scores.append(x)
-        total_sum += x
-
-    probs = []
-    for score in exp_scores:
-        probs.append(score / total_sum)
-    return probs
+    """Get the indexes of the n-best logits of every row, best first.
+
+    Equal logits are ranked by index, as a stable sort of each row would do,
+    but only the top of the row is sorted.
+    """
+    n_best_size = min(n_best_size, logits.shape[1])
+    if n_best_size == 0:
+        return np.zeros((logits.shape[0], 0), dtype=np.int64)
+    threshold = np.partition(logits, -n_best_size, axis=1)[:, -n_best_size, None]
+    # everything above the threshold is in, fill up with the first logits equal to it
+    is_above = logits > threshold
+    is_equal = logits == threshold
+    num_missing = n_best_size - np.count_nonzero(is_above, axis=1)[:, None]
+    is_best = is_above | (is_equal & (np.cumsum(is_equal, axis=1) <= num_missing))
+    best_indexes = np.nonzero(is_best)[1].reshape(logits.shape[0], n_best_size)
+    order = np.argsort(-np.take_along_axis(logits, best_indexes, axis=1), axis=1, kind="stable")
+    return np.take_along_axis(best_indexes, order, axis=1)
+
+
+def _compute_softmax(scores, starts, sizes):
+    """Compute softmax probability over raw logits, separately for each scores[start:start + size]."""
+    if not len(scores):
+        return np.zeros(0, dtype=np.float64)
+    max_scores = np.repeat(np.maximum.reduceat(scores, starts), sizes)
+    exp_scores = np.exp((scores - max_scores).astype(np.float64))
+    return exp_scores / np.repeat(np.add.reduceat(exp_scores, starts), sizes)
+
+
+# the inputs fed by run_batch, other inputs such as the 1-D unique ids are not sliced by sequence length
+SEQUENCE_INPUTS = ["input_ids:0", "input_mask:0", "segment_ids:0"]
+
+
+def has_dynamic_sequence_axis(sess):
+    """Whether all sequence inputs of the model accept any sequence length."""
+    shapes = {input_meta.name: input_meta.shape for input_meta in sess.get_inputs()}
+    return all(name in shapes and len(shapes[name]) > 1 and not isinstance(shapes[name][1], int)
+               for name in SEQUENCE_INPUTS)
+
+
+def make_batches(seq_lengths, batch_size, max_seq_length, bucketing=False, multiple=8):
+    """Split the features into batches of (feature indexes, sequence length to run them with).
+
+    Without bucketing the batches are taken in feature order and padded to
+    max_seq_length. With bucketing the features are sorted by their true length
+    first, so a batch only needs to be padded to its longest feature, rounded up
+    to a multiple of `multiple` to keep the number of distinct shapes small.
+    """
+    if not bucketing:
+        return [(np.arange(start, min(start + batch_size, len(seq_lengths))), max_seq_length)
+                for start in range(0, len(seq_lengths), batch_size)]
+    order = np.argsort(seq_lengths, kind="stable")
+    batches = []
+    for start in range(0, len(order), batch_size):
+        batch = order[start:start + batch_size]
+        padded_length = -(-int(seq_lengths[batch[-1]]) // multiple) * multiple
+        batches.append((batch, min(padded_length, max_seq_length)))
+    return batches
+
+
+def _pad_logits(logits, max_seq_length):
+    # logits of padding that was never run are -inf, so they can't make it into the n-best
+    if len(logits) == max_seq_length:
+        return logits
+    padded_logits = np.full(max_seq_length, -np.inf, dtype=logits.dtype)
+    padded_logits[:len(logits)] = logits
+    return padded_logits
+
+
+def run_batch(sess, input_ids, input_mask, segment_ids, batch, seq_length, max_seq_length):
+    """Run the features in batch with their first seq_length ids and return their RawResults."""
+    data = {"input_ids:0": input_ids[batch, :seq_length],
+            "input_mask:0": input_mask[batch, :seq_length],
+            "segment_ids:0": segment_ids[batch, :seq_length]}
+    result = sess.run(["unstack:0", "unstack:1"], data)
+    in_batch = result[0].shape[1]
+    return [RawResult(unique_id=int(batch[i]),
+                      start_logits=_pad_logits(result[0][0][i], max_seq_length),
+                      end_logits=_pad_logits(result[1][0][i], max_seq_length))
+            for i in range(0, in_batch)]
+
+
+class StageCounter(object):
+    """Throughput of a processing stage, which may be updated from several threads."""
+
+    def __init__(self, name, unit):
+        self.name = name
+        self.unit = unit
+        self.items = 0
+        self.busy = 0.0
+        self.first_start = None
+        self.last_end = None
+        self.lock = threading.Lock()
+
+    def add(self, items, start, end):
+        """Count items which were processed from start to end (timer() values)."""
+        with self.lock:
+            self.items += items
+            self.busy += end - start
+            self.first_start = start if self.first_start is None else min(self.first_start, start)
+            self.last_end = end if self.last_end is None else max(self.last_end, end)
+
+    def __str__(self):
+        elapsed = (self.last_end - self.first_start) if self.items else 0.0
+        return "{}: {} {} in {:.3f}sec, {:.1f} {}/sec, busy {:.3f}sec".format(
+            self.name, self.items, self.unit, elapsed, self.items / elapsed if elapsed else 0.0, self.unit,
+            self.busy)
+
+
+def _get(q, stop):
+    # get which returns None once the pipeline is stopped
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return None
+
+
+def _put(q, item, stop):
+    # bounded put which gives up once the pipeline is stopped, so no stage blocks forever
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+
+def _windowed_map(executor, window_size, fn, items, *args):
+    """Yield fn(item, *args) of every item in order, with at most window_size of them submitted
+    to executor ahead of the consumer. Unlike executor.map this does not submit all items up front,
+    so results the consumer hasn't taken yet can't pile up in memory."""
+    pending = collections.deque()
+    for item in items:
+        if len(pending) >= window_size:
+            yield pending.popleft().result()
+        pending.append(executor.submit(fn, item, *args))
+    while pending:
+        yield pending.popleft().result()
+
+
+def run_pipeline(examples, tokenizer, sessions, args, counters):
+    """Tokenize, infer and decode chunks of examples as overlapping stages.
+
+    A tokenizer thread converts chunks of args.chunk_size examples to features,
+    on a process pool with args.preprocess_workers > 1. A dispatcher thread
+    submits the batches of every chunk to a pool of args.inference_threads threads
+    which share the sessions, and the calling thread decodes the n-best of each
+    chunk once its batches are done. Stages are connected by queues holding at
+    most args.queue_size chunks, and the process pool works on at most as many
+    chunks ahead of the tokenized queue.
+    :return: predictions and n-best lists of all examples, keyed by qas_id
+    """
+    tokenized = queue.Queue(maxsize=args.queue_size)
+    inferred = queue.Queue(maxsize=args.queue_size)
+    stop = threading.Event()
+    chunks = [examples[start:start + args.chunk_size] for start in range(0, len(examples), args.chunk_size)]
+
+    def tokenize():
+        executor = None
+        try:
+            if args.preprocess_workers > 1:
+                executor = ProcessPoolExecutor(max_workers=args.preprocess_workers, initializer=_init_feature_worker,
+                                               initargs=(tokenizer,))
+                # keep every worker busy, but don't tokenize further ahead than the queues allow
+                all_features = _windowed_map(executor, max(args.queue_size, args.preprocess_workers),
+                                             _convert_shard, chunks, args.max_seq_length, args.doc_stride,
+                                             args.max_query_length)
+            else:
+                all_features = (convert_examples_to_features(chunk, tokenizer, args.max_seq_length,
+                                                             args.doc_stride, args.max_query_length)
+                                for chunk in chunks)
+            start = timer()
+            for (chunk, features) in zip(chunks, all_features):
+                features[3].inv_vocab = tokenizer.inv_vocab
+                counters["tokenize"].add(len(chunk), start, timer())
+                _put(tokenized, (chunk, features), stop)
+                if stop.is_set():
+                    break
+                start = timer()
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+            _put(tokenized, None, stop)
+
+    def infer(sess, input_ids, input_mask, segment_ids, batch, seq_length):
+        start = timer()
+        results = run_batch(sess, input_ids, input_mask, segment_ids, batch, seq_length, args.max_seq_length)
+        counters["inference"].add(len(results), start, timer())
+        return results
+
+    def dispatch(inference_executor):
+        try:
+            batch_index = 0
+            while True:
+                item = _get(tokenized, stop)
+                if item is None:
+                    break
+                chunk, (input_ids, input_mask, segment_ids, extra_data) = item
+                futures = []
+                for (batch, seq_length) in make_batches(input_mask.sum(axis=1), args.batch_size,
+                                                        args.max_seq_length, args.bucketing):
+                    # InferenceSession.run is thread safe, batches go round robin over the sessions
+                    sess = sessions[batch_index % len(sessions)]
+                    futures.append(inference_executor.submit(infer, sess, input_ids, input_mask, segment_ids,
+                                                             batch, seq_length))
+                    batch_index += 1
+                _put(inferred, (chunk, extra_data, futures), stop)
+        finally:
+            _put(inferred, None, stop)
+
+    all_predictions = collections.OrderedDict()
+    all_nbest_json = collections.OrderedDict()
+    with ThreadPoolExecutor(max_workers=args.inference_threads) as inference_executor, \
+            ThreadPoolExecutor(max_workers=2) as stage_executor:
+        stages = [stage_executor.submit(tokenize), stage_executor.submit(dispatch, inference_executor)]
+        try:
+            while True:
+                item = inferred.get()
+                if item is None:
+                    break
+                chunk, extra_data, futures = item
+                all_results = [result for future in futures for result in future.result()]
+                start = timer()
+                predictions, nbest_json = get_predictions(chunk, extra_data, all_results, args.n_best_size,
+                                                          args.max_answer_length, True)
+                all_predictions.update(predictions)
+                all_nbest_json.update(nbest_json)
+                counters["decode"].add(len(chunk), start, timer())
+        finally:
+            stop.set()
+        # re-raise errors of the other stages
+        for stage in stages:
+            stage.result()
+    return all_predictions, all_nbest_json
 
 
 def main():
@@ -520,62 +899,112 @@ def main():
     parser.add_argument('--n_best_size', type=int, default=20, help='n_best_size')
     parser.add_argument('--doc_stride', type=int, default=128, help='doc_stride')
     parser.add_argument('--batch_size', type=int, default=1, help='batch_size')
+    parser.add_argument('--no_bucketing', action='store_true',
+                        help='run features in input order padded to max_seq_length, even if the model '
+                             'has a dynamic sequence axis')
+    parser.add_argument('--preprocess_workers', type=int, default=1,
+                        help='number of processes to convert the examples to features with')
+    parser.add_argument('--feature_cache_dir',
+                        help='directory to cache the converted features in, reused while the predict file, '
+                             'vocab and conversion arguments are unchanged. Not used with --pipeline')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='tokenize, run and decode chunks of examples as overlapping stages')
+    parser.add_argument('--chunk_size', type=int, default=256,
+                        help='number of examples the pipeline stages pass on at a time')
+    parser.add_argument('--queue_size', type=int, default=4,
+                        help='number of chunks which can wait between two pipeline stages')
+    parser.add_argument('--sessions', type=int, default=1,
+                        help='number of InferenceSessions the pipeline runs batches on')
+    parser.add_argument('--inference_threads', type=int, default=None,
+                        help='number of threads running batches in the pipeline, defaults to --sessions')
+    parser.add_argument('--intra_op_threads', type=int, default=0,
+                        help='intra op threads of each session, 0 lets onnxruntime decide')
+    parser.add_argument('--inter_op_threads', type=int, default=0,
+                        help='inter op threads of each session, 0 lets onnxruntime decide')
     parser.add_argument('--profile', action='store_true', help='enable chrome timeline trace profiling.')
     parser.add_argument('--log', type=int, help='log level.')
     args = parser.parse_args()
 
-    sess_options = None
+    sess_options = onnxrt.SessionOptions()
+    sess_options.intra_op_num_threads = args.intra_op_threads
+    sess_options.inter_op_num_threads = args.inter_op_threads
     if args.profile:
-        sess_options = onnxrt.SessionOptions()
         sess_options.enable_profiling = True
         sess_options.profile_file_prefix = os.path.basename(args.model)
     if args.log:
-        sess_options = onnxrt.SessionOptions()
         sess_options.session_log_verbosity_level = args.log
 
     tokenizer = tokenization.FullTokenizer(vocab_file=args.vocab_file, do_lower_case=True)
 
-    eval_examples = read_squad_examples(input_file=args.predict_file)
-    input_ids, input_mask, segment_ids, extra_data = \
-        convert_examples_to_features(eval_examples, tokenizer, args.max_seq_length,
-                                     args.doc_stride, args.max_query_length)
-
     # Start from ORT 1.10, ORT requires explicitly setting the providers parameter if you want to use execution providers
     # other than the default CPU provider (as opposed to the previous behavior of providers getting set/registered by default
     # based on the build flags) when instantiating InferenceSession.
     # For example, if NVIDIA GPU is available and ORT Python package is built with CUDA, then call API as following:
     # onnxrt.InferenceSession(path/to/model, providers=['CUDAExecutionProvider'])
-    sess = onnxrt.InferenceSession(args.model, sess_options)
+    sessions = [onnxrt.InferenceSession(args.model, sess_options)
+                for _ in range(args.sessions if args.pipeline else 1)]
+    sess = sessions[0]
     for input_meta in sess.get_inputs():
         print(input_meta)
-    n = len(input_ids)
-    bs = args.batch_size
-    all_results = []
+    args.bucketing = not args.no_bucketing and has_dynamic_sequence_axis(sess)
+    args.inference_threads = args.inference_threads or len(sessions)
+
+    counters = collections.OrderedDict([("tokenize", StageCounter("tokenize", "examples")),
+                                        ("inference", StageCounter("inference", "features")),
+                                        ("decode", StageCounter("decode", "examples"))])
     start = timer()
-    for idx in range(0, n, bs):
-        data = {"input_ids:0": input_ids[idx:idx + bs],
-                "input_mask:0": input_mask[idx:idx + bs],
-                "segment_ids:0": segment_ids[idx:idx + bs]}
-        result = sess.run(["unstack:0", "unstack:1"], data)
-        in_batch = result[0].shape[1]
-        for i in range(0, in_batch):
-            unique_id = len(all_results)
-            all_results.append(RawResult(unique_id=unique_id, start_logits=result[0][0][i], end_logits=result[1][0][i]))
-            if unique_id > 0 and unique_id % 100 == 0:
-                print("at {} {}sec per item".format(unique_id, (timer() - start) / unique_id))
+    if args.pipeline:
+        eval_examples = read_squad_examples(input_file=args.predict_file)
+        all_predictions, all_nbest_json = run_pipeline(eval_examples, tokenizer, sessions, args, counters)
+    else:
+        cached = None
+        if args.feature_cache_dir:
+            cache_key = get_feature_cache_key(args.predict_file, args.vocab_file, args.max_seq_length,
+                                              args.doc_stride, args.max_query_length)
+            cached = load_feature_cache(args.feature_cache_dir, cache_key, tokenizer.inv_vocab)
+            print("feature cache {} for {}".format("hit" if cached else "miss", cache_key))
+        if cached:
+            eval_examples, input_ids, input_mask, segment_ids, extra_data = cached
+        else:
+            eval_examples = read_squad_examples(input_file=args.predict_file)
+            input_ids, input_mask, segment_ids, extra_data = \
+                convert_examples_to_features_parallel(eval_examples, tokenizer, args.max_seq_length,
+                                                      args.doc_stride, args.max_query_length,
+                                                      args.preprocess_workers)
+            if args.feature_cache_dir:
+                save_feature_cache(args.feature_cache_dir, cache_key, eval_examples, input_ids, input_mask,
+                                   segment_ids, extra_data)
+        counters["tokenize"].add(len(eval_examples), start, timer())
+
+        batches = make_batches(input_mask.sum(axis=1), args.batch_size, args.max_seq_length, args.bucketing)
+        print("running {} batches{}".format(len(batches), " bucketed by sequence length" if args.bucketing else ""))
+        # results are stored at their feature's position, whatever order the batches run in
+        all_results = [None] * len(input_ids)
+        for (batch, seq_length) in batches:
+            batch_start = timer()
+            for result in run_batch(sess, input_ids, input_mask, segment_ids, batch, seq_length,
+                                    args.max_seq_length):
+                all_results[result.unique_id] = result
+            counters["inference"].add(len(batch), batch_start, timer())
+
+        decode_start = timer()
+        all_predictions, all_nbest_json = get_predictions(eval_examples, extra_data, all_results,
+                                                          args.n_best_size, args.max_answer_length, True)
+        counters["decode"].add(len(eval_examples), decode_start, timer())
     end = timer()
 
-    print("total time: {}sec, {}sec per item".format(end - start, (end - start) / len(all_results)))
+    for counter in counters.values():
+        print(counter)
+    print("total time: {}sec, {}sec per example".format(end - start, (end - start) / max(len(eval_examples), 1)))
 
     if args.output_dir:
         output_prediction_file = os.path.join(args.output_dir, "predictions.json")
         output_nbest_file = os.path.join(args.output_dir, "nbest_predictions.json")
-        write_predictions(eval_examples, extra_data, all_results,
-                          args.n_best_size, args.max_answer_length,
-                          True, output_prediction_file, output_nbest_file)
+        write_prediction_files(all_predictions, all_nbest_json, output_prediction_file, output_nbest_file)
     if args.profile:
-        trace_file = sess.end_profiling()
-        print("trace file written to: {}".format(trace_file))
+        for sess in sessions:
+            trace_file = sess.end_profiling()
+            print("trace file written to: {}".format(trace_file))
     return 0
 
 
@@ -21,8 +21,10 @@ from __future__ import division
 from __future__ import print_function
 
 import collections
+import functools
 import re
 import unicodedata
+import numpy as np
 import six
 import tensorflow as tf
 
@@ -163,11 +165,22 @@ def whitespace_tokenize(text):
 class FullTokenizer(object):
   """Runs end-to-end tokenziation."""
 
-  def __init__(self, vocab_file, do_lower_case=True):
+  def __init__(self, vocab_file, do_lower_case=True, use_trie=True):
+    """Constructs a FullTokenizer.
+
+    Args:
+      vocab_file: Path to the vocabulary file, one token per line.
+      do_lower_case: Whether to lower case the input.
+      use_trie: Whether to use TrieWordpieceTokenizer, which gives the same
+        output as WordpieceTokenizer but is faster.
+    """
     self.vocab = load_vocab(vocab_file)
     self.inv_vocab = {v: k for k, v in self.vocab.items()}
     self.basic_tokenizer = BasicTokenizer(do_lower_case=do_lower_case)
-    self.wordpiece_tokenizer = WordpieceTokenizer(vocab=self.vocab)
+    if use_trie:
+      self.wordpiece_tokenizer = TrieWordpieceTokenizer(vocab=self.vocab)
+    else:
+      self.wordpiece_tokenizer = WordpieceTokenizer(vocab=self.vocab)
 
   def tokenize(self, text):
     split_tokens = []
@@ -177,6 +190,79 @@ class FullTokenizer(object):
 
     return split_tokens
 
+  def tokenize_to_ids(self, text):
+    """Tokenizes a piece of text straight into vocab ids."""
+    vocab = self.vocab
+    return [vocab[sub_token]
+            for token in self.basic_tokenizer.tokenize(text)
+            for sub_token in self.wordpiece_tokenizer.tokenize(token)]
+
+  def encode_batch(self, texts, max_seq_length, text_pairs=None):
+    """Tokenizes a batch of texts straight into padded BERT input arrays.
+
+    Each row is `[CLS] text [SEP]`, or `[CLS] text [SEP] pair [SEP]` if
+    `text_pairs` is given, followed by zero padding. Sequences that do not fit
+    are truncated one token at a time from the longer of the two.
+
+    Args:
+      texts: List of texts.
+      max_seq_length: Length of the rows.
+      text_pairs: Optional list of second texts, one for each text.
+
+    Returns:
+      Tuple of int64 arrays (input_ids, input_mask, segment_ids), each of shape
+      (len(texts), max_seq_length).
+    """
+    ids = [self.tokenize_to_ids(text) for text in texts]
+    id_pairs = None
+    if text_pairs is not None:
+      id_pairs = [self.tokenize_to_ids(text) for text in text_pairs]
+    return self.encode_ids_batch(ids, max_seq_length, id_pairs)
+
+  def encode_ids_batch(self, ids, max_seq_length, id_pairs=None):
+    """Same as `encode_batch`, for texts already converted to vocab ids.
+
+    Args:
+      ids: List of sequences (lists or arrays) of vocab ids.
+      max_seq_length: Length of the rows.
+      id_pairs: Optional list of second sequences of ids, one for each of ids.
+
+    Returns:
+      Tuple of int64 arrays (input_ids, input_mask, segment_ids), each of shape
+      (len(ids), max_seq_length).
+    """
+    num_special_tokens = 2 if id_pairs is None else 3
+    if max_seq_length < num_special_tokens:
+      raise ValueError("max_seq_length %d is too short for the special tokens" %
+                       max_seq_length)
+    shape = (len(ids), max_seq_length)
+    input_ids = np.zeros(shape, dtype=np.int64)
+    input_mask = np.zeros(shape, dtype=np.int64)
+    segment_ids = np.zeros(shape, dtype=np.int64)
+    cls_id = self.vocab["[CLS]"]
+    sep_id = self.vocab["[SEP]"]
+
+    for i, ids_a in enumerate(ids):
+      ids_b = () if id_pairs is None else id_pairs[i]
+      length_a, length_b = _truncated_lengths(
+          len(ids_a), len(ids_b), max_seq_length - num_special_tokens)
+
+      row = input_ids[i]
+      row[0] = cls_id
+      end = 1 + length_a
+      row[1:end] = ids_a[:length_a]
+      row[end] = sep_id
+      end += 1
+      if id_pairs is not None:
+        pair_start = end
+        end += length_b
+        row[pair_start:end] = ids_b[:length_b]
+        row[end] = sep_id
+        end += 1
+        segment_ids[i, pair_start:end] = 1
+      input_mask[i, :end] = 1
+    return input_ids, input_mask, segment_ids
+
   def convert_tokens_to_ids(self, tokens):
     return convert_by_vocab(self.vocab, tokens)
 
@@ -184,6 +270,21 @@ class FullTokenizer(object):
     return convert_by_vocab(self.inv_vocab, ids)
 
 
+def _truncated_lengths(length_a, length_b, max_length):
+  """Returns the lengths of a sequence pair truncated to the maximum length."""
+
+  # This is a simple heuristic which will always truncate the longer sequence
+  # one token at a time. This makes more sense than truncating an equal percent
+  # of tokens from each, since if one sequence is very short then each token
+  # that's truncated likely contains more information than a longer sequence.
+  while length_a + length_b > max_length:
+    if length_a > length_b:
+      length_a -= 1
+    else:
+      length_b -= 1
+  return length_a, length_b
+
+
 class BasicTokenizer(object):
   """Runs basic tokenization (punctuation splitting, lower casing, etc.)."""
 
@@ -196,7 +297,26 @@ class BasicTokenizer(object):
     self.do_lower_case = do_lower_case
 
   def tokenize(self, text):
-    """Tokenizes a piece of text."""
+    """Tokenizes a piece of text.
+
+    Gives the same tokens as running _clean_text, _tokenize_chinese_chars,
+    _run_strip_accents and _run_split_on_punc one after another (see
+    _tokenize_reference), but in a few str.translate passes.
+    """
+    text = convert_to_unicode(text)
+    if text.isascii():
+      # Nothing to strip and no CJK characters. Lower casing doesn't change
+      # what is punctuation, so it can go first.
+      if self.do_lower_case:
+        text = text.lower()
+      return text.translate(_ASCII_TABLE).split()
+    if not self.do_lower_case:
+      return text.translate(_CLEAN_PUNC_TABLE).split()
+    text = text.translate(_CLEAN_TABLE).lower()
+    return unicodedata.normalize("NFD", text).translate(_STRIP_ACCENTS_PUNC_TABLE).split()
+
+  def _tokenize_reference(self, text):
+    """Tokenizes a piece of text one step at a time."""
     text = convert_to_unicode(text)
     text = self._clean_text(text)
 
@@ -265,25 +385,7 @@ class BasicTokenizer(object):
 
   def _is_chinese_char(self, cp):
     """Checks whether CP is the codepoint of a CJK character."""
-    # This defines a "chinese character" as anything in the CJK Unicode block:
-    #   https://en.wikipedia.org/wiki/CJK_Unified_Ideographs_(Unicode_block)
-    #
-    # Note that the CJK Unicode block is NOT all Japanese and Korean characters,
-    # despite its name. The modern Korean Hangul alphabet is a different block,
-    # as is Japanese Hiragana and Katakana. Those alphabets are used to write
-    # space-separated words, so they are not treated specially and handled
-    # like the all of the other languages.
-    if ((cp >= 0x4E00 and cp <= 0x9FFF) or  #
-        (cp >= 0x3400 and cp <= 0x4DBF) or  #
-        (cp >= 0x20000 and cp <= 0x2A6DF) or  #
-        (cp >= 0x2A700 and cp <= 0x2B73F) or  #
-        (cp >= 0x2B740 and cp <= 0x2B81F) or  #
-        (cp >= 0x2B820 and cp <= 0x2CEAF) or
-        (cp >= 0xF900 and cp <= 0xFAFF) or  #
-        (cp >= 0x2F800 and cp <= 0x2FA1F)):  #
-      return True
-
-    return False
+    return _is_chinese_char(cp)
 
   def _clean_text(self, text):
     """Performs invalid character removal and whitespace cleanup on text."""
@@ -361,6 +463,103 @@ class WordpieceTokenizer(object):
     return output_tokens
 
 
+class TrieWordpieceTokenizer(WordpieceTokenizer):
+  """Runs WordPiece tokenziation over a trie of the vocab.
+
+  Gives the same output as WordpieceTokenizer, but finds the longest vocab
+  match at each position in a single walk of the trie instead of building and
+  looking up every shorter substring. Words are memoized in a bounded LRU
+  cache since the same words keep coming up in a corpus.
+  """
+
+  def __init__(self, vocab, unk_token="[UNK]", max_input_chars_per_word=200,
+               cache_size=65536):
+    super(TrieWordpieceTokenizer, self).__init__(
+        vocab, unk_token=unk_token,
+        max_input_chars_per_word=max_input_chars_per_word)
+    # Pieces at the start of a word are matched as-is, pieces inside a word
+    # are matched without their "##" prefix.
+    self.start_trie = {}
+    self.continuation_trie = {}
+    for token in vocab:
+      _trie_insert(self.start_trie, token, token)
+      if token.startswith("##"):
+        _trie_insert(self.continuation_trie, token[2:], token)
+    self.cache_size = cache_size
+    self._tokenize_word = functools.lru_cache(maxsize=cache_size)(
+        self._tokenize_word_uncached)
+
+  def __getstate__(self):
+    # The LRU cache wraps a bound method and cannot be pickled, e.g. to send the
+    # tokenizer to worker processes. It is recreated empty on unpickling.
+    state = self.__dict__.copy()
+    del state["_tokenize_word"]
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._tokenize_word = functools.lru_cache(maxsize=self.cache_size)(
+        self._tokenize_word_uncached)
+
+  def tokenize(self, text):
+    """Tokenizes a piece of text into its word pieces.
+
+    Args:
+      text: A single token or whitespace separated tokens. This should have
+        already been passed through `BasicTokenizer.
+
+    Returns:
+      A list of wordpiece tokens.
+    """
+
+    text = convert_to_unicode(text)
+
+    output_tokens = []
+    for token in whitespace_tokenize(text):
+      output_tokens.extend(self._tokenize_word(token))
+    return output_tokens
+
+  def _tokenize_word_uncached(self, token):
+    if len(token) > self.max_input_chars_per_word:
+      return (self.unk_token,)
+
+    start = 0
+    sub_tokens = []
+    trie = self.start_trie
+    while start < len(token):
+      cur_substr, end = _trie_longest_match(trie, token, start)
+      if cur_substr is None:
+        return (self.unk_token,)
+      sub_tokens.append(cur_substr)
+      start = end
+      trie = self.continuation_trie
+    return tuple(sub_tokens)
+
+
+def _trie_insert(trie, chars, token):
+  """Adds `token` to the trie under the path `chars`."""
+  node = trie
+  for char in chars:
+    node = node.setdefault(char, {})
+  # None never collides with a character key.
+  node[None] = token
+
+
+def _trie_longest_match(trie, text, start):
+  """Returns the longest vocab token matching `text` from `start` and its end."""
+  node = trie
+  match = None
+  end = start
+  for i in range(start, len(text)):
+    node = node.get(text[i])
+    if node is None:
+      break
+    if None in node:
+      match = node[None]
+      end = i + 1
+  return match, end
+
+
 def _is_whitespace(char):
   """Checks whether `chars` is a whitespace character."""
   # \t, \n, and \r are technically contorl characters but we treat them
@@ -399,3 +598,77 @@ def _is_punctuation(char):
   if cat.startswith("P"):
     return True
   return False
+
+
+def _is_chinese_char(cp):
+  """Checks whether CP is the codepoint of a CJK character."""
+  # This defines a "chinese character" as anything in the CJK Unicode block:
+  #   https://en.wikipedia.org/wiki/CJK_Unified_Ideographs_(Unicode_block)
+  #
+  # Note that the CJK Unicode block is NOT all Japanese and Korean characters,
+  # despite its name. The modern Korean Hangul alphabet is a different block,
+  # as is Japanese Hiragana and Katakana. Those alphabets are used to write
+  # space-separated words, so they are not treated specially and handled
+  # like the all of the other languages.
+  if ((cp >= 0x4E00 and cp <= 0x9FFF) or  #
+      (cp >= 0x3400 and cp <= 0x4DBF) or  #
+      (cp >= 0x20000 and cp <= 0x2A6DF) or  #
+      (cp >= 0x2A700 and cp <= 0x2B73F) or  #
+      (cp >= 0x2B740 and cp <= 0x2B81F) or  #
+      (cp >= 0x2B820 and cp <= 0x2CEAF) or
+      (cp >= 0xF900 and cp <= 0xFAFF) or  #
+      (cp >= 0x2F800 and cp <= 0x2FA1F)):  #
+    return True
+
+  return False
+
+
+def _clean_char(char):
+  """Returns what _clean_text and _tokenize_chinese_chars make of a character."""
+  cp = ord(char)
+  if cp == 0 or cp == 0xfffd or _is_control(char):
+    return None
+  if _is_whitespace(char):
+    return " "
+  if _is_chinese_char(cp):
+    return " " + char + " "
+  return char
+
+
+def _split_punc_char(char):
+  """Returns what _run_split_on_punc (and the final split) make of a character."""
+  if _is_punctuation(char):
+    return " " + char + " "
+  return char
+
+
+def _clean_split_punc_char(char):
+  cleaned = _clean_char(char)
+  if cleaned == char:
+    return _split_punc_char(char)
+  return cleaned
+
+
+def _strip_accents_split_punc_char(char):
+  if unicodedata.category(char) == "Mn":
+    return None
+  return _split_punc_char(char)
+
+
+class _TranslationTable(dict):
+  """A str.translate table which maps each character once, on first use."""
+
+  def __init__(self, map_char):
+    super(_TranslationTable, self).__init__()
+    self.map_char = map_char
+
+  def __missing__(self, cp):
+    value = self.map_char(chr(cp))
+    self[cp] = value
+    return value
+
+
+_CLEAN_TABLE = _TranslationTable(_clean_char)
+_CLEAN_PUNC_TABLE = _TranslationTable(_clean_split_punc_char)
+_STRIP_ACCENTS_PUNC_TABLE = _TranslationTable(_strip_accents_split_punc_char)
+_ASCII_TABLE = {cp: _clean_split_punc_char(chr(cp)) for cp in range(128)}
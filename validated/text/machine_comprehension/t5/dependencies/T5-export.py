@@ -1,7 +1,7 @@
 # SPDX-License-Identifier: Apache-2.0
 
 from transformers import T5ForConditionalGeneration
-from .models import CombinedDecoder, SimplifiedT5Encoder
+from .models import CombinedDecoder, CombinedDecoderWithPast, SimplifiedT5Encoder
 import torch
 
 
@@ -33,53 +33,139 @@ def turn_model_into_encoder_decoder(model):
     return simplified_encoder, decoder_with_lm_head
 
 
-def generate_onnx_representation(pretrained_version=None, output_prefix=None, model=None):
+def turn_model_into_decoder_with_past(model):
+    return CombinedDecoderWithPast(model.decoder, model.lm_head, model.config)
+
+
+def get_past_names(prefix, num_layers):
+    """ Names of the flat past key/values of CombinedDecoderWithPast, e.g. past_key_values.0.decoder.key """
+    return [f"{prefix}.{layer}.{attention}.{tensor}" for layer in range(num_layers)
+            for attention in ("decoder", "encoder") for tensor in ("key", "value")]
+
+
+def generate_onnx_representation(pretrained_version=None, output_prefix=None, model=None, with_past=False,
+                                 with_attention_mask=False):
     """ Exports a given huggingface pretrained model, or a given model and tokenizer, to onnx
 
     Args:
         pretrained_version (str): Name of a pretrained model, or path to a pretrained / finetuned version of T5
         output_prefix (str): Path to the onnx file
+        with_past (bool): also export the decoder with lm head taking and returning past key/values, as
+            {output_prefix}-decoder-init.onnx for the first step and {output_prefix}-decoder-with-past.onnx for the
+            following ones. See GenerativeT5 for how to use them.
+        with_attention_mask (bool): add an attention_mask input to the encoder and an encoder_attention_mask input
+            to the decoders, which batches of padded prompts need (see GenerativeT5.generate_batch)
     """
     if (pretrained_version is None or output_prefix is None) and model is None:
         print("You need to specify both pretrained_version (the pretrained model you wish to export) and output_prefix"
               "(the path you want to export to). Alternatively you can export a model you have in memory.")
         return
-    if model is not None:
-        # Transform model into encoder and decoder with lm head
-        simplified_encoder, decoder_with_lm_head = turn_model_into_encoder_decoder(model)
-    else:
+    if model is None:
         # Loading model_data
-        simplified_encoder, decoder_with_lm_head = create_t5_encoder_decoder(pretrained_version)
+        model = T5ForConditionalGeneration.from_pretrained(pretrained_version)
+    # Transform model into encoder and decoder with lm head
+    simplified_encoder, decoder_with_lm_head = turn_model_into_encoder_decoder(model)
 
     # Example sequence
     input_ids = torch.tensor([[42] * 10])
+    attention_mask = torch.ones_like(input_ids)
+    mask_args, mask_names, mask_axes = (), [], {}
+    encoder_mask_args, encoder_mask_names, encoder_mask_axes = (), [], {}
+    if with_attention_mask:
+        mask_args, mask_names = (attention_mask,), ['encoder_attention_mask']
+        mask_axes = {'encoder_attention_mask': {0:'batch', 1: 'encoder_sequence'}}
+        encoder_mask_args, encoder_mask_names = (attention_mask,), ['attention_mask']
+        encoder_mask_axes = {'attention_mask': {0:'batch', 1: 'sequence'}}
 
     # Exports to ONNX
     _ = torch.onnx.export(
                             decoder_with_lm_head,
-                            (input_ids, simplified_encoder(input_ids)),
+                            (input_ids, simplified_encoder(input_ids)) + mask_args,
                                    f"{output_prefix}-decoder-with-lm-head.onnx",
                                    export_params=True,
                             opset_version=12,
-                            input_names=['input_ids', 'encoder_hidden_states'],
+                            input_names=['input_ids', 'encoder_hidden_states'] + mask_names,
                             output_names=['hidden_states'],
                             dynamic_axes={
                               'input_ids': {0:'batch', 1: 'sequence'},
-                              'encoder_hidden_states': {0:'batch', 1: 'sequence'},
+                              'encoder_hidden_states': {0:'batch', 1: 'encoder_sequence'},
                               'hidden_states': {0:'batch', 1: 'sequence'},
+                              **mask_axes,
                             })
 
     _ = torch.onnx._export(
                             simplified_encoder,
-                                   input_ids,
+                                   (input_ids,) + encoder_mask_args,
                                    f"{output_prefix}-encoder.onnx",
                                    export_params=True,
                             opset_version=12,
-                            input_names=['input_ids'],
+                            input_names=['input_ids'] + encoder_mask_names,
                             output_names=['hidden_states'],
                             dynamic_axes={
                                'input_ids': {0:'batch', 1: 'sequence'},
                                'encoder_hidden_states': {0:'batch', 1: 'sequence'},
                                'hidden_states': {0:'batch', 1: 'sequence'},
+                               **encoder_mask_axes,
                             }
                            )
+
+    if with_past:
+        generate_onnx_decoder_with_past(turn_model_into_decoder_with_past(model), simplified_encoder, output_prefix,
+                                        with_attention_mask)
+
+
+def generate_onnx_decoder_with_past(decoder_with_past, simplified_encoder, output_prefix, with_attention_mask=False):
+    """ Exports CombinedDecoderWithPast once without past key/values, to decode the first token and return the past,
+        and once with them, to decode one more token at a time """
+    decoder_with_past.eval()
+    input_ids = torch.tensor([[42] * 10])
+    with torch.no_grad():
+        encoder_hidden_states = simplified_encoder(input_ids)
+    num_layers = decoder_with_past.config.num_decoder_layers
+    past_names = get_past_names("past_key_values", num_layers)
+    present_names = get_past_names("present", num_layers)
+    # without attention mask, the None argument is no input of the onnx model
+    encoder_attention_mask, mask_names, mask_axes = None, [], {}
+    if with_attention_mask:
+        encoder_attention_mask = torch.ones_like(input_ids)
+        mask_names = ['encoder_attention_mask']
+        mask_axes = {'encoder_attention_mask': {0:'batch', 1: 'encoder_sequence'}}
+
+    # self attention key/values grow by a token every step, cross attention ones have the length of the encoder input
+    def past_axes(names, sequence):
+        return {name: {0: 'batch', 2: sequence if ".decoder." in name else 'encoder_sequence'} for name in names}
+
+    _ = torch.onnx.export(
+                            decoder_with_past,
+                            (input_ids[:, :1], encoder_hidden_states, encoder_attention_mask),
+                                   f"{output_prefix}-decoder-init.onnx",
+                                   export_params=True,
+                            opset_version=12,
+                            input_names=['input_ids', 'encoder_hidden_states'] + mask_names,
+                            output_names=['hidden_states'] + present_names,
+                            dynamic_axes={
+                              'input_ids': {0:'batch', 1: 'sequence'},
+                              'encoder_hidden_states': {0:'batch', 1: 'encoder_sequence'},
+                              'hidden_states': {0:'batch', 1: 'sequence'},
+                              **mask_axes,
+                              **past_axes(present_names, 'sequence'),
+                            })
+
+    with torch.no_grad():
+        past_key_values = decoder_with_past(input_ids[:, :1], encoder_hidden_states, encoder_attention_mask)[1:]
+    _ = torch.onnx.export(
+                            decoder_with_past,
+                            (input_ids[:, :1], encoder_hidden_states, encoder_attention_mask) + tuple(past_key_values),
+                                   f"{output_prefix}-decoder-with-past.onnx",
+                                   export_params=True,
+                            opset_version=12,
+                            input_names=['input_ids', 'encoder_hidden_states'] + mask_names + past_names,
+                            output_names=['hidden_states'] + present_names,
+                            dynamic_axes={
+                              'input_ids': {0:'batch', 1: 'sequence'},
+                              'encoder_hidden_states': {0:'batch', 1: 'encoder_sequence'},
+                              'hidden_states': {0:'batch', 1: 'sequence'},
+                              **mask_axes,
+                              **past_axes(past_names, 'past_sequence'),
+                              **past_axes(present_names, 'total_sequence'),
+                            })
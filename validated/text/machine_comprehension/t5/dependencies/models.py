@@ -1,5 +1,8 @@
 # SPDX-License-Identifier: Apache-2.0
 
+from collections import OrderedDict
+
+import numpy as np
 import torch
 import torch.nn.functional as F
 from tqdm import trange
@@ -12,11 +15,50 @@ class CombinedDecoder(torch.nn.Module):
         self.decoder = decoder
         self.lm_head = lm_head
         self.config = config
-    def forward(self, input_ids, encoder_hidden_states):
-        decoder_output = self.decoder(input_ids=input_ids, encoder_hidden_states=encoder_hidden_states)[0] * \
+    def forward(self, input_ids, encoder_hidden_states, encoder_attention_mask=None):
+        decoder_output = self.decoder(input_ids=input_ids, encoder_hidden_states=encoder_hidden_states,
+                                      encoder_attention_mask=encoder_attention_mask)[0] * \
                          (self.config.d_model ** -0.5)
         return self.lm_head(decoder_output)
 
+class CombinedDecoderWithPast(torch.nn.Module):
+    """ Decoder with the lm head which also takes and returns the past key/values, so that a generation step only
+        has to decode the newest token. Called without past key/values it decodes all input_ids and returns the first
+        past key/values.
+        The past key/values are flat, four per layer: self attention key and value, cross attention key and value """
+    def __init__(self, decoder, lm_head, config):
+        super().__init__()
+        self.decoder = decoder
+        self.lm_head = lm_head
+        self.config = config
+    def forward(self, input_ids, encoder_hidden_states, encoder_attention_mask=None, *past_key_values):
+        decoder_output = self.decoder(input_ids=input_ids, encoder_hidden_states=encoder_hidden_states,
+                                      encoder_attention_mask=encoder_attention_mask,
+                                      past_key_values=_to_decoder_past(past_key_values) if past_key_values else None,
+                                      use_cache=True)
+        logits = self.lm_head(decoder_output[0] * (self.config.d_model ** -0.5))
+        return (logits,) + _from_decoder_past(decoder_output[1])
+
+def _to_decoder_past(past_key_values):
+    """ Groups the flat past key/values by layer, in the cache class of the installed transformers if it has one """
+    layers = tuple(tuple(past_key_values[i:i + 4]) for i in range(0, len(past_key_values), 4))
+    try:
+        from transformers.cache_utils import EncoderDecoderCache
+    except ImportError:
+        return layers
+    if hasattr(EncoderDecoderCache, "from_legacy_cache"):
+        return EncoderDecoderCache.from_legacy_cache(layers)
+    return EncoderDecoderCache(layers)
+
+def _from_decoder_past(past):
+    """ Flattens the past key/values returned by the decoder, see _to_decoder_past """
+    if hasattr(past, "to_legacy_cache"):
+        past = past.to_legacy_cache()
+    elif hasattr(past, "self_attention_cache"):
+        past = [(self_layer.keys, self_layer.values, cross_layer.keys, cross_layer.values) for self_layer, cross_layer
+                in zip(past.self_attention_cache.layers, past.cross_attention_cache.layers)]
+    return tuple(tensor for layer in past for tensor in layer)
+
 class SimplifiedT5Encoder(torch.nn.Module):
     """ Creation of a class to output only the last hidden state from the encoder """
     def __init__(self, encoder):
@@ -35,9 +77,7 @@ def top_k_top_p_filtering(logits, top_k=0, top_p=0.0, filter_value=-float("Inf")
                 Nucleus filtering is described in Holtzman et al. (http://arxiv.org/abs/1904.09751)
         From: https://gist.github.com/thomwolf/1a5a29f6962089e871b94cbd09daf317
     """
-    assert (
-        logits.dim() == 1
-    )  # batch size 1 for now - could be updated for more but the code would be less clear
+    assert logits.dim() in (1, 2)  # a distribution, or a batch of them
     top_k = min(top_k, logits.size(-1))  # Safety check
     if top_k > 0:
         # Remove all tokens with a probability less than the last token of the top-k
@@ -54,10 +94,67 @@ def top_k_top_p_filtering(logits, top_k=0, top_p=0.0, filter_value=-float("Inf")
         sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[..., :-1].clone()
         sorted_indices_to_remove[..., 0] = 0
 
-        indices_to_remove = sorted_indices[sorted_indices_to_remove]
+        indices_to_remove = sorted_indices_to_remove.scatter(-1, sorted_indices, sorted_indices_to_remove)
         logits[indices_to_remove] = filter_value
     return logits
 
+class EncoderOutputCache(object):
+    """ Least recently used cache of encoder outputs, keyed by the encoder input ids (and attention mask), so that
+        generating several times from the same prompt runs the encoder once. The least recently used outputs are
+        evicted when the cached ones take more than max_bytes.
+
+        Args:
+            max_bytes (int): memory budget of the cached encoder outputs
+
+        Examples:
+            >>> encoder_cache = EncoderOutputCache(256 * 1024 * 1024)
+            >>> generative_t5 = GenerativeT5(encoder_sess, decoder_sess, tokenizer, onnx=True, encoder_cache=encoder_cache)
+            >>> generative_t5('summarize: ' + document, 64, temperature=0.)
+            >>> generative_t5.beam_search('summarize: ' + document, 64)
+            >>> encoder_cache.hits, encoder_cache.misses
+            >>> # Output: (1, 1)
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def get_key(input_ids, attention_mask=None):
+        return tuple(
+            None if tensor is None else (tuple(tensor.shape), tensor.cpu().numpy().tobytes())
+            for tensor in (input_ids, attention_mask)
+        )
+
+    def get(self, key):
+        """ Returns the cached encoder outputs for key, or None """
+        encoder_outputs = self.entries.get(key)
+        if encoder_outputs is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return encoder_outputs
+
+    def put(self, key, encoder_outputs):
+        num_bytes = _get_num_bytes(encoder_outputs)
+        if num_bytes > self.max_bytes:
+            return
+        if key in self.entries:
+            self.num_bytes -= _get_num_bytes(self.entries.pop(key))
+        self.entries[key] = encoder_outputs
+        self.num_bytes += num_bytes
+        while self.num_bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.num_bytes -= _get_num_bytes(evicted)
+
+    def clear(self):
+        self.entries.clear()
+        self.num_bytes = 0
+
+
 class GenerativeT5(torch.nn.Module):
     """ This wrapper utility function implements a single beam search to generate efficiently text.
         A lot of the credit goes to the huggingface team and its chief scientist Thomas Wolf whose implementation I based
@@ -71,6 +168,13 @@ class GenerativeT5(torch.nn.Module):
             tokenizer: huggingface tokenizer
             onnx (bool): whether to use onnx or the default pytorch
             cuda (bool): whether to use cuda or the cpu
+            decoder_with_past: optional decoder with language model head which takes and returns the past key/values
+                (CombinedDecoderWithPast or its onnx export with past). Each step then decodes only the newest token
+                instead of the whole generated sequence.
+            decoder_init: decoder for the first step, which has no past key/values yet. Only needed for onnx, where
+                it is the export of CombinedDecoderWithPast without past; in pytorch decoder_with_past does both.
+            encoder_cache: optional EncoderOutputCache, to reuse the encoder outputs of prompts which were already
+                encoded
 
         Examples:
             For pytorch:
@@ -99,14 +203,112 @@ class GenerativeT5(torch.nn.Module):
             >>> generative_t5('translate English to French: I was a victim of a series of accidents.', 16, temperature=0.)[0]
             >>> # Output: "Je suis victime d'une série d'accidents."
 
+            For onnx with past key/values, exported by generate_onnx_representation(..., with_past=True):
+            >>> decoder_init_sess = InferenceSession('~/t5-decoder-init.onnx')
+            >>> decoder_with_past_sess = InferenceSession('~/t5-decoder-with-past.onnx')
+            >>> generative_t5 = GenerativeT5(encoder_sess, decoder_sess, tokenizer, onnx=True,
+            ...                              decoder_with_past=decoder_with_past_sess, decoder_init=decoder_init_sess)
+
+            With beam search, see beam_search:
+            >>> generative_t5.beam_search('translate English to French: I was a victim of a series of accidents.', 16,
+            ...                           num_beams=4)[0][0]
+
+            Many prompts at once, see generate_batch:
+            >>> generative_t5.generate_batch(['translate English to French: I was a victim of a series of accidents.',
+            ...                               'translate English to German: The house is wonderful.'], 16, temperature=0.)
+
     """
-    def __init__(self, encoder, decoder_with_lm_head, tokenizer, onnx=False, cuda=False):
+    def __init__(self, encoder, decoder_with_lm_head, tokenizer, onnx=False, cuda=False, decoder_with_past=None,
+                 decoder_init=None, encoder_cache=None):
         super().__init__()
         self.encoder = encoder
         self.decoder_with_lm_head = decoder_with_lm_head
         self.tokenizer = tokenizer
         self.onnx = onnx
         self.cuda = cuda
+        self.decoder_with_past = decoder_with_past
+        self.decoder_init = decoder_init if decoder_init is not None else decoder_with_past
+        self.encoder_cache = encoder_cache
+        if onnx:
+            self.input_names = {session: {session_input.name for session_input in session.get_inputs()}
+                                for session in (encoder, decoder_with_lm_head, self.decoder_init, decoder_with_past)
+                                if session is not None}
+        if onnx and decoder_with_past is not None:
+            self.past_names = [session_input.name for session_input in decoder_with_past.get_inputs()
+                               if session_input.name.startswith("past_key_values")]
+
+    def _encode(self, input_ids, attention_mask=None):
+        """ Returns the encoder outputs of a batch of input_ids, from the encoder cache if they are in it """
+        if self.encoder_cache is not None:
+            key = self.encoder_cache.get_key(input_ids, attention_mask)
+            encoder_outputs = self.encoder_cache.get(key)
+            if encoder_outputs is None:
+                encoder_outputs = self._run_encoder(input_ids, attention_mask)
+                self.encoder_cache.put(key, encoder_outputs)
+            return encoder_outputs
+        return self._run_encoder(input_ids, attention_mask)
+
+    def _run_encoder(self, input_ids, attention_mask=None):
+        if self.onnx:
+            inputs = {"input_ids": input_ids.cpu().numpy()}
+            if "attention_mask" in self.input_names[self.encoder]:
+                inputs["attention_mask"] = (attention_mask if attention_mask is not None
+                                            else torch.ones_like(input_ids)).cpu().numpy()
+            return self.encoder.run(None, inputs)[0]
+        if attention_mask is None:
+            return self.encoder(input_ids)
+        return self.encoder(input_ids, attention_mask=attention_mask)
+
+    def _decode_step(self, generated, encoder_outputs_prompt, past, encoder_attention_mask=None, logits_buffer=None):
+        """ Returns the logits for the token following each row of generated, and the past key/values for the next
+            step (None when decoding without them)
+            With onnx, the past key/values are the OrtValues of the previous step, fed back without copying them.
+            logits_buffer: optional numpy array of shape [batch, 1, vocabulary] the decoder with past writes its
+                logits to, instead of allocating them at every step. The returned logits are then a view of it.
+        """
+        if self.decoder_with_past is None:
+            decoder, input_ids = self.decoder_with_lm_head, generated
+        elif past is None:
+            # the first step decodes the whole start of the sequence, later ones only the newest token
+            decoder, input_ids = self.decoder_init, generated
+        else:
+            decoder, input_ids = self.decoder_with_past, generated[:, -1:]
+
+        if self.onnx:
+            # the export drops encoder_hidden_states when all cross attention key/values come from the past
+            input_names = self.input_names[decoder]
+            io_binding = decoder.io_binding()
+            io_binding.bind_cpu_input("input_ids", input_ids.cpu().numpy())
+            if "encoder_hidden_states" in input_names:
+                io_binding.bind_cpu_input("encoder_hidden_states", encoder_outputs_prompt)
+            if "encoder_attention_mask" in input_names:
+                io_binding.bind_cpu_input("encoder_attention_mask",
+                                          encoder_attention_mask.cpu().numpy() if encoder_attention_mask is not None
+                                          else np.ones(encoder_outputs_prompt.shape[:2], dtype=np.int64))
+            if past is not None:
+                for name, value in zip(self.past_names, past):
+                    io_binding.bind_ortvalue_input(name, value)
+            output_names = [session_output.name for session_output in decoder.get_outputs()]
+            # only the logits of the decoder with past keep the same shape from step to step
+            if logits_buffer is not None and past is not None:
+                io_binding.bind_output(output_names[0], "cpu", 0, logits_buffer.dtype, logits_buffer.shape,
+                                       logits_buffer.ctypes.data)
+            else:
+                io_binding.bind_output(output_names[0])
+                logits_buffer = None
+            for name in output_names[1:]:
+                io_binding.bind_output(name)
+            decoder.run_with_iobinding(io_binding)
+            outputs = io_binding.get_outputs()
+            logits = torch.from_numpy(logits_buffer if logits_buffer is not None else outputs[0].numpy())
+            return logits[:, -1], (outputs[1:] if self.decoder_with_past is not None else None)
+
+        if self.decoder_with_past is None:
+            outputs = decoder(input_ids=input_ids, encoder_hidden_states=encoder_outputs_prompt,
+                              encoder_attention_mask=encoder_attention_mask)
+            return outputs[:, -1], None
+        outputs = decoder(input_ids, encoder_outputs_prompt, encoder_attention_mask, *(past or ()))
+        return outputs[0][:, -1], outputs[1:]
 
     def forward(self, prompt, max_length, temperature=1., repetition_penalty=1., top_k=50, top_p=0, max_context_length=512):
         """ Forward function to generate text after a prompt
@@ -117,42 +319,214 @@ class GenerativeT5(torch.nn.Module):
 
         """
         with torch.no_grad():
-            new_tokens = torch.tensor(())
-            new_logits = []
-            generated = torch.tensor(self.tokenizer(prompt)['input_ids'])[:max_context_length - 1].unsqueeze(0)
+            input_ids = torch.tensor(self.tokenizer(prompt)['input_ids'])[:max_context_length - 1].unsqueeze(0)
             if self.cuda and not self.onnx:
-                generated = generated.cuda()
+                input_ids = input_ids.cuda()
 
             # Getting encoder past
-            if self.onnx:
-                encoder_outputs_prompt = self.encoder.run(None, {"input_ids": generated.cpu().numpy()})[0]
-            else:
-                encoder_outputs_prompt = self.encoder(generated)
+            encoder_outputs_prompt = self._encode(input_ids)
+
+            # The sequence now needs to start with a 0, the generated tokens are written after it
+            generated = torch.zeros((1, max_length + 1), dtype=torch.long, device=input_ids.device)
+            length = 1
+            next_token = torch.zeros(1, dtype=torch.long, device=input_ids.device)
+            # allocated at the first step, once the size of the vocabulary is known
+            new_logits = None
+            penalty = None
+            logits_buffer = None
 
-            # The sequence now needs to start with a
-            generated = torch.zeros((1,1), dtype=torch.long)
+            past = None
+            for step in trange(max_length):
+                next_token_logits, past = self._decode_step(generated[:, :length], encoder_outputs_prompt, past,
+                                                            logits_buffer=logits_buffer)
+                if new_logits is None:
+                    vocab_size = next_token_logits.shape[-1]
+                    new_logits = next_token_logits.new_empty((max_length, vocab_size))
+                    # divides the logits of the tokens in generated, the start token included
+                    penalty = next_token_logits.new_ones(vocab_size)
+                    penalty[0] = repetition_penalty
+                    if self.onnx and self.decoder_with_past is not None:
+                        logits_buffer = np.empty((1, 1, vocab_size), dtype=next_token_logits.numpy().dtype)
+
+                next_token_logits = torch.div(next_token_logits[0], temperature if temperature > 0 else 1.0,
+                                              out=new_logits[step])
+                torch.argmax(next_token_logits, dim=0, keepdim=True, out=next_token)
+                if int(next_token) == 1:
+                    break
+                next_token_logits.div_(penalty)
+                if temperature == 0:  # greedy sampling:
+                    torch.argmax(next_token_logits, dim=0, keepdim=True, out=next_token)
+                else:
+                    filtered_logits = top_k_top_p_filtering(next_token_logits, top_k=top_k, top_p=top_p)
+                    torch.multinomial(F.softmax(filtered_logits, dim=-1), num_samples=1, out=next_token)
+                generated[0, length:length + 1] = next_token
+                length += 1
+                penalty.scatter_(0, next_token, repetition_penalty)
+
+            return self.tokenizer.decode(generated[0, 1:length]), list(new_logits[:length - 1])
+
+    def generate_batch(self, prompts, max_length, temperature=1., repetition_penalty=1., top_k=50, top_p=0,
+                       max_context_length=512):
+        """ Generates text after each of the prompts, like forward, but decodes all of them in lockstep
+            The prompts are padded to the same length and encoded at once, with an attention mask hiding the padding
+            from the encoder and the decoder. A sequence is dropped from the batch as soon as it is done, so the
+            following steps only decode the remaining ones.
+            With onnx, prompts of different lengths need the attention mask inputs which
+            generate_onnx_representation(..., with_attention_mask=True) exports.
+            Args:
+                prompts: list of str, see forward
+            Returns:
+                list with the (text, logits) forward would return for each prompt
+        """
+        with torch.no_grad():
+            prompt_ids = [self.tokenizer(prompt)['input_ids'][:max_context_length - 1] for prompt in prompts]
+            lengths = torch.tensor([len(ids) for ids in prompt_ids])
+            input_ids = torch.full((len(prompts), int(lengths.max())), self.tokenizer.pad_token_id, dtype=torch.long)
+            for row, ids in enumerate(prompt_ids):
+                input_ids[row, :len(ids)] = torch.tensor(ids, dtype=torch.long)
+            attention_mask = None
+            if bool((lengths != lengths.max()).any()):
+                attention_mask = (torch.arange(input_ids.shape[1])[None, :] < lengths[:, None]).long()
+                if self.onnx and not all("attention_mask" in names or "encoder_attention_mask" in names
+                                         for names in self.input_names.values()):
+                    raise ValueError("Prompts of different lengths need onnx models exported with attention masks, "
+                                     "see generate_onnx_representation(..., with_attention_mask=True)")
+            generated = torch.zeros((len(prompts), 1), dtype=torch.long)
             if self.cuda and not self.onnx:
-                generated = generated.cuda()
+                input_ids, generated = input_ids.cuda(), generated.cuda()
+                attention_mask = attention_mask.cuda() if attention_mask is not None else None
+
+            encoder_outputs_prompt = self._encode(input_ids, attention_mask)
 
+            new_tokens = [[] for _ in prompts]
+            new_logits = [[] for _ in prompts]
+            # prompt of each row of the batch, rows are dropped when their sequence is done
+            active = list(range(len(prompts)))
+            past = None
             for _ in trange(max_length):
-                if self.onnx:
-                    outputs = torch.tensor(self.decoder_with_lm_head.run(None, {"input_ids": generated.cpu().numpy(),
-                                                   "encoder_hidden_states": encoder_outputs_prompt})[0][0])
-                else:
-                    outputs = self.decoder_with_lm_head(input_ids=generated,
-                                                        encoder_hidden_states=encoder_outputs_prompt)[0]
-                next_token_logits = outputs[-1, :] / (temperature if temperature > 0 else 1.0)
-                if int(next_token_logits.argmax()) == 1:
-                    break
-                new_logits.append(next_token_logits)
-                for _ in set(generated.view(-1).tolist()):
-                    next_token_logits[_] /= repetition_penalty
+                next_token_logits, past = self._decode_step(generated, encoder_outputs_prompt, past, attention_mask)
+                next_token_logits = next_token_logits / (temperature if temperature > 0 else 1.0)
+                is_done = next_token_logits.argmax(dim=-1) == 1
+                if bool(is_done.any()):
+                    keep = (~is_done).nonzero().view(-1)
+                    if len(keep) == 0:
+                        break
+                    active = [active[row] for row in keep.tolist()]
+                    generated, next_token_logits = generated[keep], next_token_logits[keep]
+                    encoder_outputs_prompt = _select_rows(encoder_outputs_prompt, keep)
+                    attention_mask = _select_rows(attention_mask, keep)
+                    past = [_select_rows(tensor, keep) for tensor in past] if past is not None else None
+
+                # divide the logits of all tokens generated so far, once each
+                is_generated = torch.zeros_like(next_token_logits, dtype=torch.bool).scatter_(1, generated, True)
+                next_token_logits = torch.where(is_generated, next_token_logits / repetition_penalty,
+                                                next_token_logits)
+                for row, prompt_index in enumerate(active):
+                    new_logits[prompt_index].append(next_token_logits[row])
                 if temperature == 0:  # greedy sampling:
-                    next_token = torch.argmax(next_token_logits).unsqueeze(0)
+                    next_token = torch.argmax(next_token_logits, dim=-1, keepdim=True)
                 else:
                     filtered_logits = top_k_top_p_filtering(next_token_logits, top_k=top_k, top_p=top_p)
                     next_token = torch.multinomial(F.softmax(filtered_logits, dim=-1), num_samples=1)
-                generated = torch.cat((generated, next_token.unsqueeze(0)), dim=1)
-                new_tokens = torch.cat((new_tokens, next_token), 0)
+                generated = torch.cat((generated, next_token), dim=1)
+                for prompt_index, token in zip(active, next_token.view(-1).tolist()):
+                    new_tokens[prompt_index].append(token)
+
+            return [(self.tokenizer.decode(tokens), logits) for tokens, logits in zip(new_tokens, new_logits)]
+
+    def beam_search(self, prompt, max_length, num_beams=4, length_penalty=1., no_repeat_ngram_size=0,
+                    num_return_sequences=1, max_context_length=512):
+        """ Generates text after a prompt with beam search, keeping the num_beams most likely sequences at each step
+            The beams are the rows of the batch of a single decoder call per step, with the same decoder (and past
+            key/values) as forward.
+            Args:
+                prompt: str to run, see forward
+                num_beams: number of sequences kept at each step
+                length_penalty: finished sequences are ranked by their log probability divided by
+                    length ** length_penalty, so values above 0 favor longer sequences
+                no_repeat_ngram_size: if above 0, no n-gram of this size is generated twice
+                num_return_sequences: number of finished sequences to return, at most num_beams
+                max_context_length: maximum number of tokens to use as context
+            Returns:
+                list of (text, score) of the best sequences, best first
+        """
+        with torch.no_grad():
+            input_ids = torch.tensor(self.tokenizer(prompt)['input_ids'])[:max_context_length - 1].unsqueeze(0)
+            if self.cuda and not self.onnx:
+                input_ids = input_ids.cuda()
+
+            # the prompt is encoded once, every beam decodes from the same encoder outputs
+            encoder_outputs_prompt = _select_rows(self._encode(input_ids), torch.zeros(num_beams, dtype=torch.long))
+
+            generated = torch.zeros((num_beams, 1), dtype=torch.long, device=input_ids.device)
+            # all beams start with the same sequence, only expand the first one at the first step
+            beam_scores = torch.full((num_beams,), -float("Inf"), device=input_ids.device)
+            beam_scores[0] = 0.
+            finished = []  # (score, tokens) of the sequences which generated eos
+            past = None
+            for step in trange(max_length):
+                next_token_logits, past = self._decode_step(generated, encoder_outputs_prompt, past)
+                log_probs = F.log_softmax(next_token_logits.float(), dim=-1)
+                if no_repeat_ngram_size > 0 and generated.shape[1] >= no_repeat_ngram_size:
+                    log_probs = _block_repeated_ngrams(log_probs, generated, no_repeat_ngram_size)
+
+                # the 2 * num_beams best continuations over all beams, enough to have num_beams of them without eos
+                vocab_size = log_probs.shape[-1]
+                candidate_scores, candidates = (beam_scores[:, None] + log_probs).view(-1).topk(2 * num_beams)
+                candidate_beams = candidates // vocab_size
+                candidate_tokens = candidates % vocab_size
+
+                is_eos = candidate_tokens == 1
+                # like in forward, the eos token is not part of the returned text
+                for rank in is_eos[:num_beams].nonzero().view(-1).tolist():
+                    score = float(candidate_scores[rank]) / (step + 1) ** length_penalty
+                    finished.append((score, generated[candidate_beams[rank], 1:].tolist()))
+                finished = sorted(finished, key=lambda hypothesis: -hypothesis[0])[:num_beams]
+
+                # stop once no running beam, scored at its current length, beats the worst finished sequence
+                if len(finished) == num_beams and \
+                        float(beam_scores.max()) / (step + 1) ** length_penalty <= finished[-1][0]:
+                    break
+
+                keep = (~is_eos).nonzero().view(-1)[:num_beams]
+                beams = candidate_beams[keep]
+                beam_scores = candidate_scores[keep]
+                generated = torch.cat((generated[beams], candidate_tokens[keep].unsqueeze(1)), dim=1)
+                past = [_select_rows(tensor, beams) for tensor in past] if past is not None else None
+            else:
+                # the sequences which are still running when max_length is reached compete with the finished ones
+                running = [(float(score) / max_length ** length_penalty, tokens[1:])
+                           for score, tokens in zip(beam_scores, generated.tolist())]
+                finished = sorted(finished + running, key=lambda hypothesis: -hypothesis[0])[:num_beams]
+
+            return [(self.tokenizer.decode(tokens), score) for score, tokens in finished[:num_return_sequences]]
+
+
+def _block_repeated_ngrams(log_probs, generated, ngram_size):
+    """ Returns log_probs where the tokens which would complete an n-gram already in the same row of generated
+        are impossible """
+    ngrams = generated.unfold(1, ngram_size, 1)  # [rows, number of n-grams, ngram_size]
+    # n-grams starting like the one the next token completes
+    matches = (ngrams[:, :, :-1] == generated[:, None, generated.shape[1] - ngram_size + 1:]).all(dim=-1)
+    # scatter_add rather than scatter, as the same token may end several n-grams
+    is_banned = torch.zeros_like(log_probs, dtype=torch.long).scatter_add_(1, ngrams[:, :, -1], matches.long()) > 0
+    return log_probs.masked_fill(is_banned, -float("Inf"))
+
+
+def _get_num_bytes(batch):
+    """ Returns the size in bytes of a torch or numpy batch """
+    if isinstance(batch, torch.Tensor):
+        return batch.element_size() * batch.nelement()
+    return batch.nbytes
+
 
-            return self.tokenizer.decode(new_tokens), new_logits
+def _select_rows(batch, rows):
+    """ Returns the given rows of a torch, numpy or onnxruntime batch """
+    if batch is None:
+        return None
+    if isinstance(batch, torch.Tensor):
+        return batch[rows.to(batch.device)]
+    if isinstance(batch, np.ndarray):
+        return batch[rows.cpu().numpy()]
+    # onnxruntime OrtValue
+    return type(batch).ortvalue_from_numpy(batch.numpy()[rows.cpu().numpy()])
@@ -2,8 +2,8 @@
 
 from cpuinfo import get_cpu_info
 import ort_test_dir_utils
-import onnxruntime
 import onnx
+from onnx.external_data_helper import uses_external_data
 import os
 from shutil import rmtree
 import tarfile
@@ -14,32 +14,60 @@ def has_vnni_support():
     return "avx512vnni" in set(get_cpu_info()["flags"])
 
 
-def run_onnx_checker(model_path):
-    model = onnx.load(model_path)
+def run_onnx_checker(model_path, model_context=None):
+    model = model_context.model if model_context else onnx.load(model_path)
     onnx.checker.check_model(model)
 
 
-def ort_skip_reason(model_path):
+def ort_skip_reason(model_path, model_context=None):
+    if model_context is None:
+        model_context = ort_test_dir_utils.ModelContext(model_path)
     if (model_path.endswith("-int8.onnx") or model_path.endswith("-qdq.onnx")) and not has_vnni_support():
         # At least run InferenceSession to test shape inference
-        onnxruntime.InferenceSession(model_path)
+        model_context.create_session()
         return f"Skip ORT test for {model_path} because this machine lacks avx512vnni support and the output.pb was produced with avx512vnni support."
-    model = onnx.load(model_path)
+    model = model_context.model
     if model.opset_import[0].version < 7:
         return f"Skip ORT test for {model_path} because ORT only supports opset version >= 7"
     return None
 
 
+def load_model_from_archive(model_archive):
+    """Return a ModelContext for the model read by test_utils.read_test_data_from_tar.
+    Return None if the archive cannot be checked in memory and has to be extracted instead."""
+    if model_archive.model_bytes is None or not model_archive.test_data_sets:
+        return None
+    model = onnx.load_model_from_string(model_archive.model_bytes)
+    if any(uses_external_data(initializer) for initializer in model.graph.initializer):
+        return None
+    return ort_test_dir_utils.ModelContext(model_archive.model_path, model_archive.model_bytes, model)
+
+
+def run_backend_ort_in_memory(model_archive, model_context, batched=False, comparator=None):
+    """Return False if the ORT test was skipped on this machine, see ort_skip_reason."""
+    skip_reason = ort_skip_reason(model_archive.model_path, model_context)
+    if skip_reason:
+        print(skip_reason)
+        return False
+    ort_test_dir_utils.run_test_data(model_context, model_archive.test_data_sets, batched, comparator)
+    return True
+
+
 def make_tarfile(output_filename, source_dir):
     with tarfile.open(output_filename, "w:gz", format=tarfile.GNU_FORMAT) as tar:
         tar.add(source_dir, arcname=os.path.basename(source_dir))
 
 
-def run_backend_ort(model_path, test_data_set=None, tar_gz_path=None):
-    skip_reason = ort_skip_reason(model_path)
+def run_backend_ort(model_path, test_data_set=None, tar_gz_path=None, ort_dir=test_utils.TEST_ORT_DIR,
+                    model_context=None, batched=False, comparator=None):
+    """Return False if the ORT test was skipped on this machine, see ort_skip_reason."""
+    # load and optimize the model only once for the skip check, test data creation and the test run
+    if model_context is None:
+        model_context = ort_test_dir_utils.ModelContext(model_path)
+    skip_reason = ort_skip_reason(model_path, model_context)
     if skip_reason:
         print(skip_reason)
-        return
+        return False
     # if "test_data_set_N" doesn't exist, create test_dir
     if not test_data_set:
         # Start from ORT 1.10, ORT requires explicitly setting the providers parameter if you want to use execution providers
@@ -47,22 +75,26 @@ def run_backend_ort(model_path, test_data_set=None, tar_gz_path=None):
         # based on the build flags) when instantiating InferenceSession.
         # For example, if NVIDIA GPU is available and ORT Python package is built with CUDA, then call API as following:
         # onnxruntime.InferenceSession(path/to/model, providers=["CUDAExecutionProvider"])
-        onnxruntime.InferenceSession(model_path)
+        model_context.create_session()
         # Get model name without .onnx
         model_name = os.path.basename(os.path.splitext(model_path)[0])
         if model_name is None:
             print(f"The model path {model_path} is invalid")
-            return
-        ort_test_dir_utils.create_test_dir(model_path, "./", test_utils.TEST_ORT_DIR)
-        ort_test_dir_utils.run_test_dir(test_utils.TEST_ORT_DIR)
-        if os.path.exists(model_name) and os.path.isdir(model_name):
-            rmtree(model_name)
-        os.rename(test_utils.TEST_ORT_DIR, model_name)
-        make_tarfile(tar_gz_path, model_name)
-        rmtree(model_name)
+            return False
+        ort_root, ort_test_name = os.path.split(ort_dir)
+        ort_test_dir_utils.create_test_dir(model_path, ort_root or "./", ort_test_name, model_context=model_context)
+        ort_test_dir_utils.run_test_dir(ort_dir, model_context, comparator=comparator)
+        # keep the renamed test dir next to ort_dir so parallel workers do not collide
+        model_dir = os.path.join(ort_root, model_name)
+        if os.path.exists(model_dir) and os.path.isdir(model_dir):
+            rmtree(model_dir)
+        os.rename(ort_dir, model_dir)
+        make_tarfile(tar_gz_path, model_dir)
+        rmtree(model_dir)
     # otherwise use the existing "test_data_set_N" as test data
     else:
         test_dir_from_tar = test_utils.get_model_directory(model_path)
-        ort_test_dir_utils.run_test_dir(test_dir_from_tar)
+        ort_test_dir_utils.run_test_dir(test_dir_from_tar, model_context, batched, comparator)
     # remove the produced test_dir from ORT
-    test_utils.remove_onnxruntime_test_dir()
+    test_utils.remove_onnxruntime_test_dir(ort_dir)
+    return True
@@ -1,6 +1,5 @@
 # SPDX-License-Identifier: Apache-2.0
 
-import hashlib
 import json
 import os
 import re
@@ -14,8 +13,16 @@ from onnxruntime.capi.onnxruntime_pybind11_state import NotImplemented
 import onnx
 from onnx import shape_inference
 import argparse
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
 from test_models import get_changed_models
-from test_utils import pull_lfs_file
+from test_utils import get_file_sha256, get_lfs_pointer_sha256, pull_lfs_files
+
+MANIFEST_FILE = "ONNX_HUB_MANIFEST.json"
+
+# Everything a worker process needs to compute the manifest entry of one README row
+ModelTask = namedtuple("ModelTask", ["model", "model_path", "model_with_data_path", "source_file",
+                                     "onnx_version", "opset_version", "tags"])
 
 
 # Acknowledgments to pytablereader codebase for this function
@@ -49,35 +56,6 @@ def parse_readme(filename):
         return [parse_html(table) for table in soup.find_all("table")]
 
 
-top_level_readme = "README.md"
-top_level_tables = parse_readme(top_level_readme)
-markdown_files = set()
-for top_level_table in top_level_tables:
-    for i, row in top_level_table.iterrows():
-        if "Model Class" in row:
-            try:
-                markdown_files.add(join(row["Model Class"].contents[0].contents[0].attrs['href'], "README.md"))
-            except AttributeError:
-                print("{} has no link to implementation".format(row["Model Class"].contents[0]))
-# Sort for reproducibility
-markdown_files = sorted(list(markdown_files))
-
-all_tables = []
-for markdown_file in markdown_files:
-    with open(markdown_file, "r") as f:
-        parsed_readme = parse_readme(markdown_file)
-        if not parsed_readme:
-            print(f"{markdown_file} needs to be updated to include a table.")
-            continue
-        for parsed in parsed_readme:
-            parsed = parsed.rename(columns={"Opset Version": "Opset version"})
-            if all(col in parsed.columns.values for col in ["Model", "Download", "Opset version", "ONNX version"]):
-                parsed["source_file"] = markdown_file
-                all_tables.append(parsed)
-            else:
-                print("Unrecognized table columns in file {}: {}".format(markdown_file, parsed.columns.values))
-
-df = pd.concat(all_tables, axis=0)
 normalize_name = {
     "Download": "model_path",
     "Download (with sample test data)": "model_with_data_path",
@@ -97,27 +75,50 @@ def prep_name(col):
         return col
 
 
-renamed = df.rename(columns={col: prep_name(col) for col in df.columns.values})
-metadata_fields = [f for f in renamed.columns.values if f not in top_level_fields]
+def parse_model_tables(top_level_readme="README.md"):
+    top_level_tables = parse_readme(top_level_readme)
+    markdown_files = set()
+    for top_level_table in top_level_tables:
+        for i, row in top_level_table.iterrows():
+            if "Model Class" in row:
+                try:
+                    markdown_files.add(join(row["Model Class"].contents[0].contents[0].attrs['href'], "README.md"))
+                except AttributeError:
+                    print("{} has no link to implementation".format(row["Model Class"].contents[0]))
+    # Sort for reproducibility
+    markdown_files = sorted(list(markdown_files))
+
+    all_tables = []
+    for markdown_file in markdown_files:
+        parsed_readme = parse_readme(markdown_file)
+        if not parsed_readme:
+            print(f"{markdown_file} needs to be updated to include a table.")
+            continue
+        for parsed in parsed_readme:
+            parsed = parsed.rename(columns={"Opset Version": "Opset version"})
+            if all(col in parsed.columns.values for col in ["Model", "Download", "Opset version", "ONNX version"]):
+                parsed["source_file"] = markdown_file
+                all_tables.append(parsed)
+            else:
+                print("Unrecognized table columns in file {}: {}".format(markdown_file, parsed.columns.values))
+
+    df = pd.concat(all_tables, axis=0)
+    return df.rename(columns={col: prep_name(col) for col in df.columns.values})
 
 
-def get_file_info(row, field, target_models=None):
+def get_rel_path(row, field):
     source_dir = split(row["source_file"])[0]
     model_file = row[field].contents[0].attrs["href"]
     # So that model relative path is consistent across OS
-    rel_path = "/".join(join(source_dir, model_file).split(os.sep))
-    if target_models is not None and rel_path not in target_models:
-        return None
-    # git-lfs pull if target .onnx or .tar.gz does not exist
-    pull_lfs_file(rel_path)
-    pull_lfs_file(rel_path.replace(".onnx", ".tar.gz"))
-    with open(rel_path, "rb") as f:
-        bytes = f.read()
-        sha256 = hashlib.sha256(bytes).hexdigest()
+    return "/".join(join(source_dir, model_file).split(os.sep))
+
+
+def get_file_info(rel_path, field):
+    # hash in chunks so that large models are never read into memory at once
     return {
         field: rel_path,
-        field.replace("_path", "") + "_sha": sha256,
-        field.replace("_path", "") + "_bytes": len(bytes),
+        field.replace("_path", "") + "_sha": get_file_sha256(rel_path),
+        field.replace("_path", "") + "_bytes": os.path.getsize(rel_path),
     }
 
 
@@ -152,16 +153,16 @@ def get_model_ports(source_file, metadata, model_name):
         }
 
         extra_ports = None
-        if "classification" in metadata["tags"]:
+        # shape inference over the full model is only needed to look up a known feature tensor
+        if "classification" in metadata["tags"] and model_name in feature_tensor_names:
             inferred_model = shape_inference.infer_shapes(onnx.load(model_path))
             nodes = list(inferred_model.graph.value_info)
-            if model_name in feature_tensor_names:
-                node_name = feature_tensor_names[model_name]
-                node = [n for n in nodes if n.name == node_name][0]
-                shape = [d.dim_value for d in list(node.type.tensor_type.shape.dim)]
-                extra_ports = {"features": [
-                    {"name": node.name, "shape": shape}
-                ]}
+            node_name = feature_tensor_names[model_name]
+            node = [n for n in nodes if n.name == node_name][0]
+            shape = [d.dim_value for d in list(node.type.tensor_type.shape.dim)]
+            extra_ports = {"features": [
+                {"name": node.name, "shape": shape}
+            ]}
 
         return io_ports, extra_ports
 
@@ -213,94 +214,212 @@ feature_tensor_names = {
     'ZFNet-512': 'gpu_0/fc7_2'
 }
 
-parser = argparse.ArgumentParser(description="Test settings")
-# default all: test by both onnx and onnxruntime
-# if target is specified, only test by the specified one
-parser.add_argument("--target", required=False, default="all", type=str,
-                    help="Update target? (all, diff, single)",
-                    choices=["all", "diff", "single"])
-parser.add_argument("--path", required=False, default=None, type=str,
-                    help="The model path which you want to update. e.g., vision/classification/resnet/model/resnet50.onnx")
-parser.add_argument("--drop", required=False, default=False, action="store_true",
-                    help="Drop downloaded models after verification. (For space limitation in CIs)")
-args = parser.parse_args()
-
-
-output = []
-if args.target == "diff":
-    changed_models = set()
-    changed_list = get_changed_models()
-    for file in changed_list:
-        # If the .tar.gz was updated, the model's manifest needs to be updated as well
-        if ".tar.gz" in file:
-            file = file.replace(".tar.gz", ".onnx")
-        changed_models.add(file)
-    print(f"{len(changed_models)} of changed models: {changed_models}")
-if args.target == "diff" or args.target == "single":
-    with open("ONNX_HUB_MANIFEST.json", "r+") as f:
-        output = json.load(f)
-    path_to_object = {}
-    for model in output:
-        path_to_object[model["model_path"]] = model
-
-for i, row in renamed.iterrows():
-    if len(row["model"].contents) > 0 and len(row["model_path"].contents) > 0:
-        model_name = row["model"].contents[0]
-        target_models = None
-        if args.target == "diff":
-            target_models = changed_models
-        elif args.target == "single":
-            if args.path is None:
-                raise ValueError("Please specify --path if you want to update by single model.")
-            target_models = set([args.path.replace("\\", "/")])
-        model_info = get_file_info(row, "model_path", target_models)
-        if model_info is None:
-            continue
-        model_path = model_info.pop("model_path")
-        metadata = model_info
-        metadata["tags"] = get_model_tags(row)
-        io_ports, extra_ports = get_model_ports(model_path, metadata, model_name)
-        if io_ports is not None:
-            metadata["io_ports"] = io_ports
-        if extra_ports is not None:
-            metadata["extra_ports"] = extra_ports
+def make_entry(task, metadata):
+    return {
+        "model": task.model,
+        "model_path": task.model_path,
+        "onnx_version": task.onnx_version,
+        "opset_version": task.opset_version,
+        "metadata": metadata
+    }
 
-        try:
-            for k, v in get_file_info(row, "model_with_data_path").items():
-                metadata[k] = v
-        except (AttributeError, FileNotFoundError) as e:
-            print(f"no model_with_data in file {row['source_file']}: {e}")
 
-        try:
-            opset = int(row["opset_version"].contents[0])
-        except ValueError:
-            print("malformed opset {} in {}".format(row["opset_version"].contents[0], row["source_file"]))
-            continue
-        if args.target != "all":
-            if model_path in path_to_object:
-                # To update existing information, remove previous one
-                output.remove(path_to_object[model_path])
-                print(f"Updating: {model_path}")
-        output.append(
-            {
-                "model": model_name,
-                "model_path": model_path,
-                "onnx_version": row["onnx_version"].contents[0],
-                "opset_version": int(row["opset_version"].contents[0]),
-                "metadata": metadata
-            }
-        )
-        if args.drop:
-            if os.path.exists(model_path):
-                os.remove(model_path)
-            tar_path = model_path.replace(".onnx", ".tar.gz")
-            if os.path.exists(tar_path):
-                os.remove(tar_path)
+def get_known_sha(rel_path, hash_cache):
+    """Return the sha256 of a file if it is known without hashing it, otherwise None."""
+    if not os.path.exists(rel_path):
+        return None
+    sha = get_lfs_pointer_sha256(rel_path)
+    if sha is None:
+        stat = os.stat(rel_path)
+        cached = hash_cache.get(rel_path)
+        if cached is not None and cached["mtime"] == stat.st_mtime and cached["bytes"] == stat.st_size:
+            sha = cached["sha"]
+    return sha
+
+
+def is_unchanged(task, entry, hash_cache):
+    metadata = entry["metadata"]
+    if entry["model"] != task.model or metadata.get("model_with_data_path") != task.model_with_data_path:
+        return False
+    if get_known_sha(task.model_path, hash_cache) != metadata.get("model_sha"):
+        return False
+    if task.model_with_data_path is not None and \
+            get_known_sha(task.model_with_data_path, hash_cache) != metadata.get("model_with_data_sha"):
+        return False
+    return True
+
+
+def pull_model_files(task):
+    # git-lfs pull if target .onnx or .tar.gz does not exist
+    pull_lfs_files(sorted({task.model_path, task.model_path.replace(".onnx", ".tar.gz")}))
 
-    else:
-        print("Missing model in {}".format(row["source_file"]))
-output.sort(key=lambda x: x["model_path"])
 
-with open("ONNX_HUB_MANIFEST.json", "w+") as f:
-    print("Found {} models".format(len(output)))
-    json.dump(output, f, indent=4)
+def build_entry(task, drop=False):
+    """Compute the manifest entry of one pulled model. Runs in a worker process.
+
+    Returns the entry and the sha256 of the hashed files together with their mtime and size.
+    """
+    metadata = get_file_info(task.model_path, "model_path")
+    metadata.pop("model_path")
+    metadata["tags"] = task.tags
+    io_ports, extra_ports = get_model_ports(task.model_path, metadata, task.model)
+    if io_ports is not None:
+        metadata["io_ports"] = io_ports
+    if extra_ports is not None:
+        metadata["extra_ports"] = extra_ports
+
+    if task.model_with_data_path is not None:
+        try:
+            for k, v in get_file_info(task.model_with_data_path, "model_with_data_path").items():
+                metadata[k] = v
+        except FileNotFoundError as e:
+            print(f"no model_with_data in file {task.source_file}: {e}")
+
+    hashed_files = {}
+    for rel_path, sha in [(task.model_path, metadata["model_sha"]),
+                          (metadata.get("model_with_data_path"), metadata.get("model_with_data_sha"))]:
+        if sha is not None:
+            stat = os.stat(rel_path)
+            hashed_files[rel_path] = {"sha": sha, "mtime": stat.st_mtime, "bytes": stat.st_size}
+
+    if drop:
+        if os.path.exists(task.model_path):
+            os.remove(task.model_path)
+        tar_path = task.model_path.replace(".onnx", ".tar.gz")
+        if os.path.exists(tar_path):
+            os.remove(tar_path)
+    return make_entry(task, metadata), hashed_files
+
+
+def generate_manifest(target="all", path=None, drop=False, jobs=1, force=False, hash_cache_file=None):
+    """Update ONNX_HUB_MANIFEST.json from the model READMEs.
+
+    Entries whose model and model_with_data files are unchanged (same sha256 according to their
+    git-lfs pointer or to the hash cache) are reused instead of being recomputed, unless force is set.
+    The remaining models are hashed and inspected on a pool of `jobs` processes. They are pulled with
+    git-lfs by this process, since concurrent pulls race on the git index, and at most `jobs` of them
+    are being inspected at once.
+    """
+    target_models = None
+    if target == "diff":
+        target_models = set()
+        changed_list = get_changed_models()
+        for file in changed_list:
+            # If the .tar.gz was updated, the model's manifest needs to be updated as well
+            if ".tar.gz" in file:
+                file = file.replace(".tar.gz", ".onnx")
+            target_models.add(file)
+        print(f"{len(target_models)} of changed models: {target_models}")
+    elif target == "single":
+        if path is None:
+            raise ValueError("Please specify --path if you want to update by single model.")
+        target_models = set([path.replace("\\", "/")])
+
+    existing = []
+    if os.path.exists(MANIFEST_FILE):
+        with open(MANIFEST_FILE, "r") as f:
+            existing = json.load(f)
+    path_to_object = {model["model_path"]: model for model in existing}
+
+    hash_cache = {}
+    if hash_cache_file is not None and os.path.exists(hash_cache_file):
+        with open(hash_cache_file, "r") as f:
+            hash_cache = json.load(f)
+
+    tasks = []
+    entries = []
+    for i, row in parse_model_tables().iterrows():
+        if len(row["model"].contents) > 0 and len(row["model_path"].contents) > 0:
+            model_path = get_rel_path(row, "model_path")
+            if target_models is not None and model_path not in target_models:
+                continue
+            try:
+                opset = int(row["opset_version"].contents[0])
+            except ValueError:
+                print("malformed opset {} in {}".format(row["opset_version"].contents[0], row["source_file"]))
+                continue
+            try:
+                model_with_data_path = get_rel_path(row, "model_with_data_path")
+            except AttributeError as e:
+                print(f"no model_with_data in file {row['source_file']}: {e}")
+                model_with_data_path = None
+            task = ModelTask(model=row["model"].contents[0], model_path=model_path,
+                             model_with_data_path=model_with_data_path, source_file=row["source_file"],
+                             onnx_version=row["onnx_version"].contents[0], opset_version=opset,
+                             tags=get_model_tags(row))
+            entry = path_to_object.get(model_path)
+            if not force and entry is not None and is_unchanged(task, entry, hash_cache):
+                # README fields are cheap to refresh, the model is not
+                metadata = dict(entry["metadata"], tags=task.tags)
+                entries.append(make_entry(task, metadata))
+            else:
+                tasks.append(task)
+        else:
+            print("Missing model in {}".format(row["source_file"]))
+    print(f"Reusing {len(entries)} unchanged models, computing {len(tasks)} models")
+
+    def add_result(result):
+        entry, hashed_files = result
+        entries.append(entry)
+        hash_cache.update(hashed_files)
+
+    if jobs == 1:
+        for task in tasks:
+            pull_model_files(task)
+            add_result(build_entry(task, drop))
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            pending = deque()
+            for task in tasks:
+                if len(pending) >= jobs:
+                    add_result(pending.popleft().result())
+                pull_model_files(task)
+                pending.append(executor.submit(build_entry, task, drop))
+            for future in pending:
+                add_result(future.result())
+
+    if target == "all":
+        output = entries
+    else:
+        # To update existing information, remove previous one
+        updated_paths = set(entry["model_path"] for entry in entries)
+        output = [model for model in existing if model["model_path"] not in updated_paths] + entries
+        for model_path in sorted(updated_paths & set(path_to_object)):
+            print(f"Updating: {model_path}")
+    output.sort(key=lambda x: x["model_path"])
+
+    with open(MANIFEST_FILE, "w+") as f:
+        print("Found {} models".format(len(output)))
+        json.dump(output, f, indent=4)
+    if hash_cache_file is not None:
+        with open(hash_cache_file, "w") as f:
+            json.dump(hash_cache, f, indent=4, sort_keys=True)
+    return output
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Test settings")
+    # default all: test by both onnx and onnxruntime
+    # if target is specified, only test by the specified one
+    parser.add_argument("--target", required=False, default="all", type=str,
+                        help="Update target? (all, diff, single)",
+                        choices=["all", "diff", "single"])
+    parser.add_argument("--path", required=False, default=None, type=str,
+                        help="The model path which you want to update. e.g., vision/classification/resnet/model/resnet50.onnx")
+    parser.add_argument("--drop", required=False, default=False, action="store_true",
+                        help="Drop downloaded models after verification. (For space limitation in CIs)")
+    parser.add_argument("--jobs", required=False, default=1, type=int,
+                        help="Number of processes to hash and inspect models with. Each of them loads a model "
+                             "into an InferenceSession, so mind the memory of large models")
+    parser.add_argument("--force", required=False, default=False, action="store_true",
+                        help="Recompute all entries even if their model files are unchanged")
+    parser.add_argument("--hash_cache", required=False, default=None, type=str,
+                        help="JSON file remembering sha256, mtime and size of downloaded models to skip rehashing")
+    args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    generate_manifest(args.target, args.path, args.drop, args.jobs, args.force, args.hash_cache)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+# SPDX-License-Identifier: Apache-2.0
+
+import json
+import os
+import pickle
+
+MANIFEST_FILE = "ONNX_HUB_MANIFEST.json"
+# bump when the pickled layout of ManifestIndex changes so that stale caches are rebuilt
+CACHE_VERSION = 1
+
+
+def get_signature(ports):
+    """Return a hashable signature of the io_ports inputs or outputs of a manifest entry.
+
+    A port is reduced to its type and shape. Symbolic dims (e.g. "unk__492" or "batch_size")
+    are named differently in every model, so they all become None.
+    """
+    return tuple(
+        (port["type"], tuple(dim if isinstance(dim, int) else None for dim in port["shape"]))
+        for port in ports
+    )
+
+
+class ManifestIndex(object):
+    """In-memory indexes over the entries of ONNX_HUB_MANIFEST.json.
+
+    The manifest is parsed once. Lookups by model name (case insensitive, as in onnx.hub), model_path
+    or model_with_data_path, tag, opset_version and io_ports signature are dict lookups.
+
+    Examples:
+        >>> index = ManifestIndex.load("ONNX_HUB_MANIFEST.json", cache_file="manifest_index.pkl")
+        >>> index.get("ResNet50")["model_path"]
+        >>> index.find(tag="classification", opset=12)
+    """
+
+    def __init__(self, entries):
+        """
+        :param entries: List of manifest entries as written by generate_onnx_hub_manifest.py.
+        """
+        self.entries = entries
+        self.by_name = {}
+        self.by_path = {}
+        self.by_tag = {}
+        self.by_opset = {}
+        self.by_input_signature = {}
+        self.by_output_signature = {}
+        for i, entry in enumerate(entries):
+            metadata = entry["metadata"]
+            self.by_name.setdefault(entry["model"].lower(), []).append(i)
+            self.by_path[entry["model_path"]] = i
+            if "model_with_data_path" in metadata:
+                self.by_path[metadata["model_with_data_path"]] = i
+            for tag in metadata.get("tags", []):
+                self.by_tag.setdefault(tag.lower(), []).append(i)
+            self.by_opset.setdefault(entry["opset_version"], []).append(i)
+            if "io_ports" in metadata:
+                self.by_input_signature.setdefault(get_signature(metadata["io_ports"]["inputs"]), []).append(i)
+                self.by_output_signature.setdefault(get_signature(metadata["io_ports"]["outputs"]), []).append(i)
+
+    @classmethod
+    def load(cls, manifest_file=MANIFEST_FILE, cache_file=None):
+        """Build the index of a manifest file.
+
+        :param cache_file: Optional pickle file to store the built index in. It is reused instead of
+                           parsing the JSON again while the manifest keeps its size and mtime.
+        """
+        stat = os.stat(manifest_file)
+        cache_key = (CACHE_VERSION, os.path.abspath(manifest_file), stat.st_size, stat.st_mtime_ns)
+        if cache_file is not None and os.path.exists(cache_file):
+            try:
+                with open(cache_file, "rb") as f:
+                    cached_key, index = pickle.load(f)
+                if cached_key == cache_key:
+                    return index
+            except (pickle.UnpicklingError, EOFError, ValueError, AttributeError):
+                print(f"Ignoring unreadable manifest index cache {cache_file}")
+
+        with open(manifest_file, "r") as f:
+            index = cls(json.load(f))
+        if cache_file is not None:
+            tmp_file = cache_file + ".tmp"
+            with open(tmp_file, "wb") as f:
+                pickle.dump((cache_key, index), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file, cache_file)
+        return index
+
+    def get(self, model, opset=None):
+        """Return the entry of a model by name, with the highest opset unless opset is given, or None."""
+        matches = [self.entries[i] for i in self.by_name.get(model.lower(), [])
+                   if opset is None or self.entries[i]["opset_version"] == opset]
+        if not matches:
+            return None
+        return max(matches, key=lambda entry: entry["opset_version"])
+
+    def get_by_path(self, model_path):
+        """Return the entry whose model_path or model_with_data_path is model_path, or None."""
+        i = self.by_path.get(model_path.replace("\\", "/"))
+        return None if i is None else self.entries[i]
+
+    def find(self, model=None, tag=None, opset=None, input_signature=None, output_signature=None):
+        """Return the entries matching all given criteria, in manifest order.
+
+        :param input_signature: Signature as returned by get_signature, or a list of io_ports to compute it from.
+        :param output_signature: Same as input_signature for the outputs.
+        """
+        if isinstance(input_signature, list):
+            input_signature = get_signature(input_signature)
+        if isinstance(output_signature, list):
+            output_signature = get_signature(output_signature)
+        lookups = []
+        if model is not None:
+            lookups.append((self.by_name, model.lower()))
+        if tag is not None:
+            lookups.append((self.by_tag, tag.lower()))
+        if opset is not None:
+            lookups.append((self.by_opset, opset))
+        if input_signature is not None:
+            lookups.append((self.by_input_signature, input_signature))
+        if output_signature is not None:
+            lookups.append((self.by_output_signature, output_signature))
+        result = None
+        for index, key in lookups:
+            matches = set(index.get(key, []))
+            result = matches if result is None else result & matches
+        if result is None:
+            return list(self.entries)
+        return [self.entries[i] for i in sorted(result)]
@@ -29,6 +29,21 @@ def read_sequenceproto_pb_file(filename):
     return seq.name, list_of_arrays
 
 
+def read_tensorproto_pb_bytes(data):
+    """Return tuple of tensor name and numpy.ndarray of the data from the serialized bytes of a TensorProto."""
+    tensor = onnx.load_tensor_from_string(data)
+    np_array = numpy_helper.to_array(tensor)
+    return tensor.name, np_array
+
+
+def read_sequenceproto_pb_bytes(data):
+    """Return tuple of sequence name and list of numpy.ndarray of the data from the serialized bytes of a SequenceProto."""
+    seq = SequenceProto()
+    seq.ParseFromString(data)
+    list_of_arrays = numpy_helper.to_list(seq)
+    return seq.name, list_of_arrays
+
+
 def dump_tensorproto_pb_file(filename):
     """Dump the data from a pb file containing a TensorProto."""
 
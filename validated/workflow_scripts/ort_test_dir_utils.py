@@ -10,11 +10,52 @@ import shutil
 import numpy as np
 import onnx
 import onnx_test_data_utils
+import output_comparator
 from onnx import numpy_helper
 
 import onnxruntime as ort
 
 
+class ModelContext(object):
+    """
+    Holds the parsed ModelProto and the InferenceSession of one model so that they are
+    created at most once, no matter how many create/run/check steps use the model.
+    Both are created lazily on first access.
+    """
+
+    def __init__(self, model_path, model_bytes=None, model=None):
+        """
+        :param model_path: Path to the onnx model file. Only used for naming if model_bytes is provided.
+        :param model_bytes: Optional serialized model to use instead of reading model_path.
+        :param model: Optional already parsed ModelProto of the model.
+        """
+        self.model_path = model_path
+        self.model_bytes = model_bytes
+        self._model = model
+        self._session = None
+
+    @property
+    def model(self):
+        if self._model is None:
+            if self.model_bytes is not None:
+                self._model = onnx.load_model_from_string(self.model_bytes)
+            else:
+                self._model = onnx.load(self.model_path)
+        return self._model
+
+    @property
+    def session(self):
+        if self._session is None:
+            # the session is created from the serialized model rather than from self.model
+            # since ORT would have to serialize the ModelProto again
+            self._session = ort.InferenceSession(self.model_bytes if self.model_bytes is not None else self.model_path)
+        return self._session
+
+    def create_session(self):
+        """Create the InferenceSession if it does not exist yet, e.g. to check that ORT can load the model."""
+        return self.session
+
+
 def _get_numpy_type(model_info, name):
     for i in model_info:
         if i.name == name:
@@ -74,7 +115,8 @@ def _create_missing_input_data(model_inputs, name_input_map, symbolic_dim_values
 
 
 def create_test_dir(
-    model_path, root_path, test_name, name_input_map=None, symbolic_dim_values_map=None, name_output_map=None
+    model_path, root_path, test_name, name_input_map=None, symbolic_dim_values_map=None, name_output_map=None,
+    model_context=None
 ):
     """
     Create a test directory that can be used with onnx_test_runner or onnxruntime_perf_test.
@@ -89,6 +131,7 @@ def create_test_dir(
                                     using random data.
     :param name_output_map: Optional map of output names to numpy ndarray expected output data.
                             If not provided, the model will be run with the input to generate output data to save.
+    :param model_context: Optional ModelContext of model_path to reuse its parsed model and session.
     :return: None
     """
 
@@ -112,7 +155,7 @@ def create_test_dir(
     test_model_filename = os.path.join(test_dir, model_filename)
     shutil.copy(model_path, test_model_filename)
 
-    model = onnx.load(model_path)
+    model = model_context.model if model_context else onnx.load(model_path)
     model_inputs = model.graph.input
     model_outputs = model.graph.output
 
@@ -140,7 +183,7 @@ def create_test_dir(
     if not symbolic_dim_values_map:
         symbolic_dim_values_map = {}
     initializer_set = set()
-    for initializer in onnx.load(model_path).graph.initializer:
+    for initializer in model.graph.initializer:
         initializer_set.add(initializer.name)
     _create_missing_input_data(model_inputs, name_input_map, symbolic_dim_values_map, initializer_set)
     save_data("input", name_input_map, model_inputs)
@@ -148,7 +191,7 @@ def create_test_dir(
     # save expected output data if provided. run model to create if not.
     if not name_output_map:
         output_names = [o.name for o in model_outputs]
-        sess = ort.InferenceSession(test_model_filename)
+        sess = model_context.session if model_context else ort.InferenceSession(test_model_filename)
         outputs = sess.run(output_names, name_input_map)
         name_output_map = {}
         for name, data in zip(output_names, outputs):
@@ -167,36 +210,211 @@ def read_test_dir(dir_name, input_types, output_types):
                    dictionary of output name to numpy.ndarray)
     """
 
+    pb_files = {}
+    for filename in glob.glob(os.path.join(dir_name, "input_*.pb")) + glob.glob(os.path.join(dir_name, "output_*.pb")):
+        with open(filename, "rb") as f:
+            pb_files[os.path.basename(filename)] = f.read()
+    return read_test_data(pb_files, input_types, output_types)
+
+
+def _pb_file_index(filename):
+    # input_10.pb has to come after input_9.pb
+    return int(os.path.splitext(filename)[0].split("_")[-1])
+
+
+def read_test_data(pb_files, input_types, output_types):
+    """
+    Read the inputs and outputs of a test data set from in-memory .pb files,
+    e.g. read from a .tar.gz or by read_test_dir.
+    :param pb_files: Map of .pb file name ('input_N.pb' or 'output_N.pb') to its serialized content
+    :return: tuple(dictionary of input name to numpy.ndarray of data,
+                   dictionary of output name to numpy.ndarray)
+    """
+
     inputs = {}
     outputs = {}
 
-    input_files = glob.glob(os.path.join(dir_name, "input_*.pb"))
-    output_files = glob.glob(os.path.join(dir_name, "output_*.pb"))
+    input_files = sorted((f for f in pb_files if f.startswith("input_")), key=_pb_file_index)
+    output_files = sorted((f for f in pb_files if f.startswith("output_")), key=_pb_file_index)
 
     for i, filename in enumerate(input_files):
         if 'seq' in input_types[i]:
-            name, data = onnx_test_data_utils.read_sequenceproto_pb_file(filename)
+            name, data = onnx_test_data_utils.read_sequenceproto_pb_bytes(pb_files[filename])
         else:
-            name, data = onnx_test_data_utils.read_tensorproto_pb_file(filename)
+            name, data = onnx_test_data_utils.read_tensorproto_pb_bytes(pb_files[filename])
         inputs[name] = data
 
     for i, filename in enumerate(output_files):
-        if 'seq' in output_files[i]:
-            name, data = onnx_test_data_utils.read_sequenceproto_pb_file(filename)
+        if 'seq' in output_types[i]:
+            name, data = onnx_test_data_utils.read_sequenceproto_pb_bytes(pb_files[filename])
         else:
-            name, data = onnx_test_data_utils.read_tensorproto_pb_file(filename)
+            name, data = onnx_test_data_utils.read_tensorproto_pb_bytes(pb_files[filename])
         outputs[name] = data
 
     return inputs, outputs
 
 
-def run_test_dir(model_or_dir):
+def _get_output_names(sess, expected_outputs):
+    if expected_outputs:
+        output_names = list(expected_outputs.keys())
+        # handle case where there's a single expected output file but no name in it (empty string for name)
+        # e.g. ONNX test models 20190729\opset8\tf_mobilenet_v2_1.4_224
+        if len(output_names) == 1 and output_names[0] == "":
+            output_names = [o.name for o in sess.get_outputs()]
+            assert len(output_names) == 1, "There should be single output_name."
+            expected_outputs[output_names[0]] = expected_outputs[""]
+            expected_outputs.pop("")
+
+    else:
+        output_names = [o.name for o in sess.get_outputs()]
+    return output_names
+
+
+def _check_outputs(output_names, expected_outputs, run_outputs, comparator, test_name):
+    failed = False
+    if expected_outputs:
+        for idx in range(len(output_names)):
+            expected = expected_outputs[output_names[idx]]
+            actual = run_outputs[idx]
+            if not comparator.compare(output_names[idx], expected, actual, test_name):
+                failed = True
+    if failed:
+        raise ValueError("FAILED due to output mismatch.")
+    else:
+        print("PASS")
+
+
+def _run_test_data_set(sess, inputs, expected_outputs, comparator, test_name):
+    output_names = _get_output_names(sess, expected_outputs)
+    run_outputs = sess.run(output_names, inputs)
+    _check_outputs(output_names, expected_outputs, run_outputs, comparator, test_name)
+
+
+def _can_batch_test_data_sets(sess, test_data):
+    """
+    Check whether the inputs of all test data sets can be concatenated along a dynamic batch dimension:
+    every model input and output has a dynamic first dim, and the data sets only differ in that dim.
+    """
+    if len(test_data) < 2:
+        return False
+    for node_arg in sess.get_inputs() + sess.get_outputs():
+        if not node_arg.shape or isinstance(node_arg.shape[0], int):
+            return False
+
+    _, first_inputs, _ = test_data[0]
+    for _, inputs, _ in test_data:
+        if inputs.keys() != first_inputs.keys():
+            return False
+        batch_sizes = set()
+        for name, data in inputs.items():
+            first = first_inputs[name]
+            if not isinstance(data, np.ndarray) or data.ndim == 0:
+                return False
+            if data.dtype != first.dtype or data.shape[1:] != first.shape[1:]:
+                return False
+            batch_sizes.add(data.shape[0])
+        if len(batch_sizes) != 1:
+            return False
+    return True
+
+
+def _run_test_data_sets_batched(sess, test_data, comparator):
+    """
+    Run all test data sets with a single sess.run by stacking them along the batch dimension,
+    then split the outputs back per data set for comparison.
+    Return False, with no comparison reported, if the data sets cannot be batched, the batched run fails or
+    its outputs mismatch, so that they are run one by one instead.
+    """
+    if not _can_batch_test_data_sets(sess, test_data):
+        return False
+    output_names = [_get_output_names(sess, expected_outputs) for _, _, expected_outputs in test_data]
+    if any(names != output_names[0] for names in output_names):
+        return False
+    output_names = output_names[0]
+
+    input_names = list(test_data[0][1].keys())
+    batched_inputs = {name: np.concatenate([inputs[name] for _, inputs, _ in test_data]) for name in input_names}
+    batch_sizes = [inputs[input_names[0]].shape[0] for _, inputs, _ in test_data]
+    split_offsets = np.cumsum(batch_sizes)[:-1]
+
+    try:
+        run_outputs = sess.run(output_names, batched_inputs)
+        for output in run_outputs:
+            if not isinstance(output, np.ndarray) or output.ndim == 0 or output.shape[0] != sum(batch_sizes):
+                print("Outputs cannot be split per test data set. Fall back to running test data sets one by one.")
+                return False
+        split_outputs = [np.split(output, split_offsets) for output in run_outputs]
+    except Exception as e:
+        # the stacked inputs may be rejected if a symbolic first dim is not a batch dim
+        print("Batched run failed: {}. Fall back to running test data sets one by one.".format(e))
+        return False
+    report_count = len(comparator.reports)
+    try:
+        for i, (name, _, expected_outputs) in enumerate(test_data):
+            print(name)
+            _check_outputs(output_names, expected_outputs, [outputs[i] for outputs in split_outputs], comparator,
+                           name)
+    except ValueError:
+        # a symbolic first dim is not necessarily a batch dim, and outputs are not necessarily per row, so
+        # a mismatch is only reported by the unbatched runs
+        del comparator.reports[report_count:]
+        print("Batched outputs mismatch. Fall back to running test data sets one by one.")
+        return False
+    return True
+
+
+def _run_test_data_sets(sess, test_data, batched, comparator):
+    """
+    :param test_data: Iterable of tuple(test data set name, inputs, expected outputs).
+    :param batched: Whether to try running all test data sets in a single batch.
+    :param comparator: OutputComparator to check the outputs with. A default one is used if None.
+    """
+    if comparator is None:
+        comparator = output_comparator.OutputComparator()
+    if batched:
+        test_data = list(test_data)
+        if _run_test_data_sets_batched(sess, test_data, comparator):
+            return
+    for name, inputs, expected_outputs in test_data:
+        print(name)
+        _run_test_data_set(sess, inputs, expected_outputs, comparator, name)
+
+
+def run_test_data(model_context, test_data_sets, batched=False, comparator=None):
+    """
+    Run the tests from in-memory test data sets without a test directory on disk.
+
+    :param model_context: ModelContext of the model to run.
+    :param test_data_sets: Map of test data set name to a map of .pb file name to its serialized content.
+    :param batched: Run all test data sets as one batch if the model has a dynamic batch dimension.
+                    Falls back to one run per test data set otherwise.
+    :param comparator: Optional OutputComparator with per-output tolerances that collects the comparison reports.
+    :return: None
+    """
+
+    if not test_data_sets:
+        raise ValueError("No test data sets were provided.")
+    sess = model_context.session
+
+    input_types = [inp.type for inp in sess.get_inputs()]
+    output_types = [out.type for out in sess.get_outputs()]
+
+    test_data = ((name,) + read_test_data(test_data_sets[name], input_types, output_types)
+                 for name in sorted(test_data_sets))
+    _run_test_data_sets(sess, test_data, batched, comparator)
+
+
+def run_test_dir(model_or_dir, model_context=None, batched=False, comparator=None):
     """
     Run the test/s from a directory in ONNX test format.
     All subdirectories with a prefix of 'test' are considered test input for one test run.
 
     :param model_or_dir: Path to onnx model in test directory,
                          or the test directory name if the directory only contains one .onnx model.
+    :param model_context: Optional ModelContext of the same model to reuse its session.
+    :param batched: Run all test data sets as one batch if the model has a dynamic batch dimension.
+                    Falls back to one run per test data set otherwise.
+    :param comparator: Optional OutputComparator with per-output tolerances that collects the comparison reports.
     :return: None
     """
 
@@ -224,44 +442,10 @@ def run_test_dir(model_or_dir):
     test_dirs = [d for d in glob.glob(os.path.join(model_dir, "test*")) if os.path.isdir(d)]
     if not test_dirs:
         raise ValueError("No directories with name starting with 'test' were found in {}.".format(model_dir))
-    sess = ort.InferenceSession(model_path)
+    sess = model_context.session if model_context else ort.InferenceSession(model_path)
 
     input_types = [inp.type for inp in sess.get_inputs()]
     output_types = [out.type for out in sess.get_outputs()]
 
-    for d in test_dirs:
-        print(d)
-        inputs, expected_outputs = read_test_dir(d, input_types, output_types)
-
-        if expected_outputs:
-            output_names = list(expected_outputs.keys())
-            # handle case where there's a single expected output file but no name in it (empty string for name)
-            # e.g. ONNX test models 20190729\opset8\tf_mobilenet_v2_1.4_224
-            if len(output_names) == 1 and output_names[0] == "":
-                output_names = [o.name for o in sess.get_outputs()]
-                assert len(output_names) == 1, "There should be single output_name."
-                expected_outputs[output_names[0]] = expected_outputs[""]
-                expected_outputs.pop("")
-
-        else:
-            output_names = [o.name for o in sess.get_outputs()]
-
-        run_outputs = sess.run(output_names, inputs)
-        failed = False
-        if expected_outputs:
-            for idx in range(len(output_names)):
-                expected = expected_outputs[output_names[idx]]
-                actual = run_outputs[idx]
-
-                if expected.dtype.char in np.typecodes["AllFloat"]:
-                    if not np.isclose(expected, actual, rtol=1.0e-3, atol=1.0e-3).all():
-                        print("Mismatch for {}:\nExpected:{}\nGot:{}".format(output_names[idx], expected, actual))
-                        failed = True
-                else:
-                    if not np.equal(expected, actual).all():
-                        print("Mismatch for {}:\nExpected:{}\nGot:{}".format(output_names[idx], expected, actual))
-                        failed = True
-        if failed:
-            raise ValueError("FAILED due to output mismatch.")
-        else:
-            print("PASS")
+    test_data = ((d,) + read_test_dir(d, input_types, output_types) for d in test_dirs)
+    _run_test_data_sets(sess, test_data, batched, comparator)
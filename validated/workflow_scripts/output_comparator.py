@@ -0,0 +1,143 @@
+# SPDX-License-Identifier: Apache-2.0
+
+import json
+
+import numpy as np
+
+DEFAULT_RTOL = 1.0e-3
+DEFAULT_ATOL = 1.0e-3
+
+
+def compare_output(name, expected, actual, rtol=DEFAULT_RTOL, atol=DEFAULT_ATOL, top_k=5):
+    """
+    Compare an output against its expected value in one vectorized pass.
+    Float outputs use the same criterion as np.isclose(expected, actual, rtol, atol), other types must be equal.
+
+    :return: dict with the mismatch count and percentage, the max absolute/relative error and the top_k
+             worst elements. The tensors themselves are never stringified.
+    """
+    expected = np.asarray(expected)
+    actual = np.asarray(actual)
+    report = {
+        "name": name,
+        "dtype": str(expected.dtype),
+        "expected_shape": list(expected.shape),
+        "actual_shape": list(actual.shape),
+    }
+    try:
+        expected, actual = np.broadcast_arrays(expected, actual)
+    except ValueError:
+        report["passed"] = False
+        report["error"] = "shape mismatch"
+        return report
+
+    is_float = expected.dtype.char in np.typecodes["AllFloat"]
+    is_numeric = is_float or expected.dtype.char in np.typecodes["AllInteger"]
+    if is_numeric:
+        abs_error = np.abs(expected.astype(np.float64) - actual.astype(np.float64))
+    if is_float:
+        report["rtol"] = rtol
+        report["atol"] = atol
+        # equal infinities are close, NaNs never are
+        mismatch = ~((abs_error <= atol + rtol * np.abs(actual)) | (expected == actual))
+    else:
+        mismatch = expected != actual
+
+    mismatch_count = int(np.count_nonzero(mismatch))
+    report["passed"] = mismatch_count == 0
+    report["mismatch_count"] = mismatch_count
+    report["mismatch_percentage"] = 100.0 * mismatch_count / mismatch.size if mismatch.size else 0.0
+    if not is_numeric or abs_error.size == 0:
+        return report
+
+    rel_error = abs_error / np.maximum(np.abs(expected.astype(np.float64)), np.finfo(np.float64).tiny)
+    report["max_abs_error"] = float(np.nanmax(abs_error)) if not np.isnan(abs_error).all() else float("nan")
+    report["max_rel_error"] = float(np.nanmax(rel_error)) if not np.isnan(rel_error).all() else float("nan")
+
+    if mismatch_count:
+        # rank mismatching elements first, NaN errors count as the worst
+        score = np.where(np.isnan(abs_error), np.inf, abs_error).ravel()
+        score = np.where(mismatch.ravel(), score, -1.0)
+        k = min(top_k, mismatch_count)
+        worst = np.argpartition(score, -k)[-k:]
+        worst = worst[np.argsort(score[worst])[::-1]]
+        report["worst"] = [
+            {
+                "index": [int(i) for i in np.unravel_index(flat_index, mismatch.shape)],
+                "expected": expected.ravel()[flat_index].item(),
+                "actual": actual.ravel()[flat_index].item(),
+                "abs_error": float(abs_error.ravel()[flat_index]),
+            }
+            for flat_index in worst
+        ]
+    return report
+
+
+def format_report(report):
+    """Return a one-line summary of a failed compare_output report."""
+    if "error" in report:
+        return "Mismatch for {}: {} (expected {}, got {})".format(
+            report["name"], report["error"], report["expected_shape"], report["actual_shape"])
+    summary = "Mismatch for {}: {}/{} elements ({:.4f}%) differ".format(
+        report["name"], report["mismatch_count"], int(np.prod(report["expected_shape"], dtype=np.int64)),
+        report["mismatch_percentage"])
+    if "max_abs_error" in report:
+        summary += ", max abs error {:.6g}, max rel error {:.6g}".format(report["max_abs_error"],
+                                                                         report["max_rel_error"])
+    if "worst" in report:
+        summary += "; worst: " + ", ".join(
+            "{} expected {} got {}".format(w["index"], w["expected"], w["actual"]) for w in report["worst"])
+    return summary
+
+
+def load_tolerances(tolerance_file):
+    """
+    Load per-model, per-output tolerances from a JSON file of the form
+    {"<model file name>": {"<output name>": {"rtol": 1e-2, "atol": 1e-4}}}.
+    """
+    with open(tolerance_file, "r") as f:
+        return json.load(f)
+
+
+def _to_json_value(value):
+    # NaN and Infinity are not valid JSON, write them as strings instead
+    if isinstance(value, float) and not np.isfinite(value):
+        return str(value)
+    if isinstance(value, dict):
+        return {key: _to_json_value(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_to_json_value(item) for item in value]
+    return value
+
+
+class OutputComparator(object):
+    """Compares model outputs with per-output tolerances and collects the reports of all comparisons."""
+
+    def __init__(self, rtol=DEFAULT_RTOL, atol=DEFAULT_ATOL, tolerances=None, top_k=5):
+        """
+        :param rtol: Default relative tolerance for float outputs.
+        :param atol: Default absolute tolerance for float outputs.
+        :param tolerances: Optional map of output name to dict with "rtol" and/or "atol" overriding the defaults.
+        :param top_k: Number of worst elements to report per mismatching output.
+        """
+        self.rtol = rtol
+        self.atol = atol
+        self.tolerances = tolerances or {}
+        self.top_k = top_k
+        self.reports = []
+
+    def compare(self, name, expected, actual, test_name=None):
+        """Compare one output, print a summary if it mismatches and return whether it passed."""
+        tolerance = self.tolerances.get(name, {})
+        report = compare_output(name, expected, actual, rtol=tolerance.get("rtol", self.rtol),
+                                atol=tolerance.get("atol", self.atol), top_k=self.top_k)
+        if test_name is not None:
+            report["test_data_set"] = test_name
+        self.reports.append(report)
+        if not report["passed"]:
+            print(format_report(report))
+        return report["passed"]
+
+    def write_report(self, report_file):
+        with open(report_file, "w") as f:
+            json.dump(_to_json_value(self.reports), f, indent=4, allow_nan=False)
@@ -2,10 +2,15 @@
 
 import argparse
 import check_model
+import ort_test_dir_utils
+import output_comparator
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
 from pathlib import Path
 import subprocess
 import sys
 import test_utils
+import validation_cache
 import os
 
 
@@ -42,6 +47,200 @@ def get_changed_models():
     return model_list
 
 
+def needs_lfs_pull(model_path, target):
+    # standalone .onnx models are only checked (and downloaded) by onnx
+    return tar_ext_name in model_path or target != "onnxruntime"
+
+
+def pull_model(model_path, prefetcher=None):
+    if prefetcher is not None:
+        prefetcher.wait(model_path)
+    else:
+        test_utils.pull_lfs_file(model_path)
+
+
+def validate_model(model_path, args, tar_dir=test_utils.TEST_TAR_DIR, ort_dir=test_utils.TEST_ORT_DIR,
+                   prefetcher=None, pulled=False):
+    """Validate a single model.
+
+    :param pulled: The LFS payload of model_path was already pulled, as for the pool workers.
+    :return: (passed, complete) where complete is False if a check of args.target was skipped on this
+             machine (see check_model.ort_skip_reason), so that the pass must not be cached.
+    """
+    model_name = model_path.split("/")[-1]
+    print("==============Testing {}==============".format(model_name))
+    passed = True
+    complete = True
+    comparator = output_comparator.OutputComparator(args.rtol, args.atol, args.tolerances.get(model_name))
+
+    try:
+        # check .tar.gz by ORT and ONNX
+        if tar_ext_name in model_name:
+            # Step 1: check the ONNX model and test_data_set from .tar.gz by ORT
+            test_data_set = []
+            model_path_from_tar = None
+            if not pulled:
+                pull_model(model_path, prefetcher)
+            # read the model and test data without extracting the .tar.gz if possible
+            model_archive = None
+            model_context = None
+            if test_utils.can_read_test_data_from_tar(model_path):
+                model_archive = test_utils.read_test_data_from_tar(model_path)
+                model_context = check_model.load_model_from_archive(model_archive)
+            in_memory = model_context is not None
+            if not in_memory:
+                # check whether "test_data_set_0" exists
+                model_path_from_tar, test_data_set = test_utils.extract_test_data(model_path, tar_dir)
+                model_context = ort_test_dir_utils.ModelContext(model_path_from_tar)
+            # if tar.gz exists, git pull and try to get test data
+            if (args.target == "onnxruntime" or args.target == "all"):
+                # finally check the ONNX model from .tar.gz by ORT
+                # if the test_data_set does not exist, create the test_data_set
+                try:
+                    if in_memory:
+                        complete = check_model.run_backend_ort_in_memory(model_archive, model_context,
+                                                                         args.batch_test_data, comparator)
+                    else:
+                        complete = check_model.run_backend_ort(model_path_from_tar, test_data_set, ort_dir=ort_dir,
+                                                               model_context=model_context,
+                                                               batched=args.batch_test_data, comparator=comparator)
+                    print("[PASS] {} is checked by onnxruntime. ".format(model_name))
+                except Exception as e:
+                    if not args.create:
+                        raise
+                    else:
+                        print("Warning: original test data for {} is broken: {}".format(model_path, e))
+                        test_utils.remove_onnxruntime_test_dir(ort_dir)
+                        # the report only covers the recreated test data
+                        del comparator.reports[:]
+                    if model_path_from_tar is None:
+                        # new test data is created from the extracted model
+                        model_path_from_tar, test_data_set = test_utils.extract_test_data(model_path, tar_dir)
+                    if (not model_name.endswith("-int8.tar.gz") and not model_name.endswith("-qdq.tar.gz")) or check_model.has_vnni_support():
+                        complete = check_model.run_backend_ort(model_path_from_tar, None, model_path,
+                                                               ort_dir=ort_dir, model_context=model_context,
+                                                               comparator=comparator)
+                    else:
+                        print("Skip quantized  models because their test_data_set was created in avx512vnni machines. ")
+                        complete = False
+                    print("[PASS] {} is checked by onnxruntime. ".format(model_name))
+            # Step 2: check the ONNX model inside .tar.gz by ONNX
+            if args.target == "onnx" or args.target == "all":
+                check_model.run_onnx_checker(model_path_from_tar, model_context)
+                print("[PASS] {} is checked by onnx. ".format(model_name))
+        # check uploaded standalone ONNX model by ONNX
+        elif onnx_ext_name in model_name:
+            if args.target == "onnx" or args.target == "all":
+                if not pulled:
+                    pull_model(model_path, prefetcher)
+                check_model.run_onnx_checker(model_path)
+                print("[PASS] {} is checked by onnx. ".format(model_name))
+
+    except Exception as e:
+        print("[FAIL] {}: {}".format(model_name, e))
+        passed = False
+
+    if args.report_dir and comparator.reports:
+        comparator.write_report(os.path.join(args.report_dir, model_name + ".json"))
+
+    # remove checked models and directories to save space in CIs
+    if os.path.exists(model_path) and args.drop:
+        os.remove(model_path)
+    test_utils.remove_onnxruntime_test_dir(ort_dir)
+    test_utils.remove_tar_dir(tar_dir)
+    # git lfs prune is repository-wide, so parallel runs prune once at the end instead
+    if args.jobs == 1:
+        test_utils.run_lfs_prune()
+    return passed, complete
+
+
+# scratch directories of the current pool worker, set up by _init_worker
+_worker_dirs = None
+
+
+def _init_worker():
+    global _worker_dirs
+    _worker_dirs = test_utils.make_worker_dirs()
+
+
+def _validate_model_in_worker(model_path, args):
+    tar_dir, ort_dir = _worker_dirs
+    # the parent process pulled the model, concurrent git lfs pulls would race on the git index
+    return validate_model(model_path, args, tar_dir, ort_dir, pulled=True)
+
+
+def _submit_validation(executor, model_path, args, prefetcher):
+    """Pull model_path in this process and submit its validation to executor.
+
+    :return: A future of the validate_model result, already failed if the pull failed.
+    """
+    if needs_lfs_pull(model_path, args.target):
+        try:
+            pull_model(model_path, prefetcher)
+        except Exception as e:
+            print("[FAIL] {}: {}".format(model_path.split("/")[-1], e))
+            failed = Future()
+            failed.set_result((False, True))
+            return failed
+    return executor.submit(_validate_model_in_worker, model_path, args)
+
+
+def validate_models(model_list, args):
+    """Validate all models and return the list of failed model paths in model_list order."""
+    cache = None
+    cache_keys = {}
+    if args.cache_file:
+        cache = validation_cache.ValidationCache(args.cache_file)
+        # compute keys before validation since --drop removes the checked models
+        cache_keys = {model_path: cache.get_key(model_path, args.target, args.rtol, args.atol,
+                                                args.tolerances.get(model_path.split("/")[-1]))
+                      for model_path in model_list}
+
+    models_to_check = []
+    for model_path in model_list:
+        if cache is not None and cache.is_passed(cache_keys[model_path]):
+            print("[PASS] {} is unchanged since its last validation (cached). ".format(model_path.split("/")[-1]))
+        else:
+            models_to_check.append(model_path)
+
+    prefetcher = None
+    if args.prefetch > 0:
+        prefetcher = test_utils.LfsPrefetcher(
+            [model_path for model_path in models_to_check if needs_lfs_pull(model_path, args.target)],
+            args.prefetch)
+    try:
+        if args.jobs == 1:
+            results = [validate_model(model_path, args, prefetcher=prefetcher) for model_path in models_to_check]
+        else:
+            results = []
+            try:
+                with ProcessPoolExecutor(max_workers=args.jobs, initializer=_init_worker) as executor:
+                    # models are pulled by this process in order, and at most jobs + prefetch of them
+                    # are on disk waiting for or under validation
+                    pending = deque()
+                    for model_path in models_to_check:
+                        while len(pending) >= args.jobs + args.prefetch:
+                            results.append(pending.popleft().result())
+                        pending.append(_submit_validation(executor, model_path, args, prefetcher))
+                    results.extend(future.result() for future in pending)
+            finally:
+                test_utils.remove_worker_dirs()
+                test_utils.run_lfs_prune()
+    finally:
+        if prefetcher is not None:
+            prefetcher.close()
+
+    failed_models = []
+    for model_path, (passed, complete) in zip(models_to_check, results):
+        if not passed:
+            failed_models.append(model_path)
+        elif cache is not None and complete:
+            cache.record_pass(cache_keys[model_path], model_path)
+    if cache is not None:
+        cache.save()
+    return failed_models
+
+
 def main():
     parser = argparse.ArgumentParser(description="Test settings")
     # default all: test by both onnx and onnxruntime
@@ -56,65 +255,37 @@ def main():
                         help="Test all ONNX Model Zoo models instead of only chnaged models")
     parser.add_argument("--drop", required=False, default=False, action="store_true",
                         help="Drop downloaded models after verification. (For space limitation in CIs)")
+    parser.add_argument("--jobs", required=False, default=1, type=int,
+                        help="Number of models to test in parallel processes")
+    parser.add_argument("--prefetch", required=False, default=0, type=int,
+                        help="Number of models to download with git lfs in the background ahead of the tested ones")
+    parser.add_argument("--batch_test_data", required=False, default=False, action="store_true",
+                        help="Run all test_data_set_N of a model in one batch if it has a dynamic batch dimension")
+    parser.add_argument("--report_dir", required=False, default=None, type=str,
+                        help="Directory to write a JSON report of the output comparisons of each model to")
+    parser.add_argument("--cache_file", required=False, default=None, type=str,
+                        help="JSON file to record passed models in and skip them while unchanged")
+    parser.add_argument("--rtol", required=False, default=output_comparator.DEFAULT_RTOL, type=float,
+                        help="Relative tolerance for float outputs")
+    parser.add_argument("--atol", required=False, default=output_comparator.DEFAULT_ATOL, type=float,
+                        help="Absolute tolerance for float outputs")
+    parser.add_argument("--tolerance_file", required=False, default=None, type=str,
+                        help="JSON file of per-output tolerances overriding --rtol/--atol, of the form "
+                             "{\"<model file name>\": {\"<output name>\": {\"rtol\": 1e-2, \"atol\": 1e-4}}}")
     args = parser.parse_args()
+    args.tolerances = output_comparator.load_tolerances(args.tolerance_file) if args.tolerance_file else {}
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+
+    if args.report_dir:
+        os.makedirs(args.report_dir, exist_ok=True)
 
     model_list = get_all_models() if args.all_models else get_changed_models()
     # run lfs install before starting the tests
     test_utils.run_lfs_install()
 
     print("\n=== Running test on ONNX models ===\n")
-    failed_models = []
-    for model_path in model_list:
-        model_name = model_path.split("/")[-1]
-        print("==============Testing {}==============".format(model_name))
-
-        try:
-            # check .tar.gz by ORT and ONNX
-            if tar_ext_name in model_name:
-                # Step 1: check the ONNX model and test_data_set from .tar.gz by ORT
-                test_data_set = []
-                test_utils.pull_lfs_file(model_path)
-                # check whether "test_data_set_0" exists
-                model_path_from_tar, test_data_set = test_utils.extract_test_data(model_path)
-                # if tar.gz exists, git pull and try to get test data
-                if (args.target == "onnxruntime" or args.target == "all"):
-                    # finally check the ONNX model from .tar.gz by ORT
-                    # if the test_data_set does not exist, create the test_data_set
-                    try:
-                        check_model.run_backend_ort(model_path_from_tar, test_data_set)
-                        print("[PASS] {} is checked by onnxruntime. ".format(model_name))
-                    except Exception as e:
-                        if not args.create:
-                            raise
-                        else:
-                            print("Warning: original test data for {} is broken: {}".format(model_path, e))
-                            test_utils.remove_onnxruntime_test_dir()
-                        if (not model_name.endswith("-int8.tar.gz") and not model_name.endswith("-qdq.tar.gz")) or check_model.has_vnni_support():
-                            check_model.run_backend_ort(model_path_from_tar, None, model_path)
-                        else:
-                            print("Skip quantized  models because their test_data_set was created in avx512vnni machines. ")
-                        print("[PASS] {} is checked by onnxruntime. ".format(model_name))
-                # Step 2: check the ONNX model inside .tar.gz by ONNX
-                if args.target == "onnx" or args.target == "all":
-                    check_model.run_onnx_checker(model_path_from_tar)
-                    print("[PASS] {} is checked by onnx. ".format(model_name))
-            # check uploaded standalone ONNX model by ONNX
-            elif onnx_ext_name in model_name:
-                if args.target == "onnx" or args.target == "all":
-                    test_utils.pull_lfs_file(model_path)
-                    check_model.run_onnx_checker(model_path)
-                    print("[PASS] {} is checked by onnx. ".format(model_name))
-
-        except Exception as e:
-            print("[FAIL] {}: {}".format(model_name, e))
-            failed_models.append(model_path)
-
-        # remove checked models and directories to save space in CIs
-        if os.path.exists(model_path) and args.drop:
-            os.remove(model_path)
-        test_utils.remove_onnxruntime_test_dir()
-        test_utils.remove_tar_dir()
-        test_utils.run_lfs_prune()
+    failed_models = validate_models(model_list, args)
 
     if len(failed_models) == 0:
         print("{} models have been checked. ".format(len(model_list)))
@@ -1,15 +1,61 @@
 # SPDX-License-Identifier: Apache-2.0
 
+from collections import namedtuple
+import hashlib
 from pathlib import Path
 import subprocess
 import tarfile
+import tempfile
+import threading
 import os
 from shutil import rmtree
 
 TEST_ORT_DIR = 'ci_test_dir'
 TEST_TAR_DIR = 'ci_test_tar_dir'
+TEST_WORKER_PREFIX = 'ci_test_worker_'
 cwd_path = Path.cwd()
 
+# ONNX model and test_data_set_N .pb files read from a .tar.gz without extracting it.
+# test_data_sets maps each test_data_set_N to a dict of .pb file name -> serialized proto.
+ModelArchive = namedtuple("ModelArchive", ["model_path", "model_bytes", "test_data_sets"])
+
+LFS_POINTER_PREFIX = b"version https://git-lfs.github.com/spec/v1"
+LFS_OID_PREFIX = "oid sha256:"
+# LFS pointer files are tiny, anything bigger is an actual payload
+LFS_POINTER_MAX_SIZE = 1024
+# .tar.gz files up to this size are read in memory, bigger ones are extracted to disk
+# so that the model and all of its test data are not held in memory at once
+IN_MEMORY_TAR_MAX_SIZE = 256 * 1024 * 1024
+
+
+def get_file_sha256(file_path, chunk_size=1 << 20):
+    """Return the sha256 of a file, reading it in chunks instead of all at once."""
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def get_lfs_pointer_sha256(file_path):
+    """Return the sha256 stored in a git-lfs pointer file, or None if the payload has already been pulled."""
+    if os.path.getsize(file_path) > LFS_POINTER_MAX_SIZE:
+        return None
+    with open(file_path, "rb") as f:
+        content = f.read()
+    if not content.startswith(LFS_POINTER_PREFIX):
+        return None
+    for line in content.decode("utf-8").splitlines():
+        if line.startswith(LFS_OID_PREFIX):
+            return line[len(LFS_OID_PREFIX):].strip()
+    return None
+
+
+def get_content_sha256(file_path):
+    # git-lfs pointers already carry the sha256 of their payload, so unchanged models
+    # can be recognized without downloading them
+    return get_lfs_pointer_sha256(file_path) or get_file_sha256(file_path)
+
 
 def get_model_directory(model_path):
     return os.path.dirname(model_path)
@@ -21,8 +67,95 @@ def run_lfs_install():
 
 
 def pull_lfs_file(file_name):
-    result = subprocess.run(['git', 'lfs', 'pull', '--include', file_name, '--exclude', '\'\''], cwd=cwd_path, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    print(f'LFS pull completed for {file_name} with return code= {result.returncode}')
+    pull_lfs_files([file_name])
+
+
+def pull_lfs_files(file_names):
+    # a single git lfs pull for several files, --include takes a comma separated list of patterns.
+    # git lfs pull updates the git index, so it must not run concurrently in the same checkout.
+    result = subprocess.run(['git', 'lfs', 'pull', '--include', ','.join(file_names), '--exclude', '\'\''], cwd=cwd_path, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    print(f'LFS pull completed for {len(file_names)} files with return code= {result.returncode}')
+    if result.returncode != 0:
+        # otherwise the LFS pointer files would be read as models later on
+        raise RuntimeError(f'git lfs pull failed for {", ".join(file_names)}: '
+                           f'{result.stderr.decode("utf-8", "replace").strip()}')
+
+
+class LfsPrefetcher(object):
+    """Pulls git-lfs files in a background thread while the previous ones are being used.
+
+    At most `depth` files ahead of the file currently in use are pulled, in batches of up to
+    `batch_size` files per `git lfs pull`. Files have to be consumed with `wait` in the given order.
+    """
+
+    def __init__(self, file_names, depth, batch_size=8):
+        self.file_names = list(file_names)
+        self.depth = depth
+        self.batch_size = batch_size
+        # number of files from the start of file_names which are pulled / handed out by wait
+        self._pulled = 0
+        self._consumed = 0
+        self._closed = False
+        # file name -> exception of its failed pull, raised by wait
+        self._errors = {}
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._closed and self._pulled >= self._consumed + self.depth:
+                    self._condition.wait()
+                if self._closed or self._pulled >= len(self.file_names):
+                    return
+                end = min(self._pulled + self.batch_size, self._consumed + self.depth, len(self.file_names))
+                batch = self.file_names[self._pulled:end]
+            errors = {}
+            try:
+                errors = self._pull(batch)
+            finally:
+                with self._condition:
+                    self._errors.update(errors)
+                    self._pulled = end
+                    self._condition.notify_all()
+
+    @staticmethod
+    def _pull(batch):
+        """Pull a batch of files and return {file name: exception} of those which failed."""
+        try:
+            pull_lfs_files(batch)
+            return {}
+        except Exception as e:
+            if len(batch) == 1:
+                return {batch[0]: e}
+        # pull the files one by one to fail only those which cannot be pulled
+        errors = {}
+        for file_name in batch:
+            try:
+                pull_lfs_file(file_name)
+            except Exception as e:
+                errors[file_name] = e
+        return errors
+
+    def wait(self, file_name):
+        """Block until file_name, the next file in order, has been pulled. Raise the error of a failed pull."""
+        with self._condition:
+            index = self._consumed
+            if self.file_names[index] != file_name:
+                raise ValueError(f'Expected {self.file_names[index]} to be consumed next instead of {file_name}')
+            self._consumed += 1
+            self._condition.notify_all()
+            while self._pulled <= index:
+                self._condition.wait()
+            if file_name in self._errors:
+                raise self._errors.pop(file_name)
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
 
 
 def run_lfs_prune():
@@ -30,11 +163,35 @@ def run_lfs_prune():
     print(f'LFS prune completed with return code= {result.returncode}')
 
 
-def extract_test_data(file_path):
+def extract_test_data(file_path, tar_dir=TEST_TAR_DIR):
     tar = tarfile.open(file_path, "r:gz")
-    tar.extractall(TEST_TAR_DIR)
+    tar.extractall(tar_dir)
     tar.close()
-    return get_model_and_test_data(TEST_TAR_DIR)
+    return get_model_and_test_data(tar_dir)
+
+
+def can_read_test_data_from_tar(file_path):
+    return os.path.getsize(file_path) <= IN_MEMORY_TAR_MAX_SIZE
+
+
+def read_test_data_from_tar(file_path):
+    # stream the members once instead of writing the whole archive to disk
+    model_path = None
+    model_bytes = None
+    test_data_sets = {}
+    with tarfile.open(file_path, "r|gz") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            file_name = os.path.basename(member.name)
+            parent_dir = os.path.basename(os.path.dirname(member.name))
+            if file_name.endswith('.onnx'):
+                assert model_bytes is None, "More than one ONNX model detected"
+                model_path = member.name
+                model_bytes = tar.extractfile(member).read()
+            elif parent_dir.startswith('test_data_set_') and file_name.endswith('.pb'):
+                test_data_sets.setdefault(parent_dir, {})[file_name] = tar.extractfile(member).read()
+    return ModelArchive(model_path, model_bytes, test_data_sets)
 
 
 def get_model_and_test_data(directory_path):
@@ -54,11 +211,25 @@ def get_model_and_test_data(directory_path):
     return onnx_model, test_data_set
 
 
-def remove_tar_dir():
-    if os.path.exists(TEST_TAR_DIR) and os.path.isdir(TEST_TAR_DIR):
-        rmtree(TEST_TAR_DIR)
+def remove_tar_dir(tar_dir=TEST_TAR_DIR):
+    if os.path.exists(tar_dir) and os.path.isdir(tar_dir):
+        rmtree(tar_dir)
+
+
+def remove_onnxruntime_test_dir(ort_dir=TEST_ORT_DIR):
+    if os.path.exists(ort_dir) and os.path.isdir(ort_dir):
+        rmtree(ort_dir)
+
+
+def make_worker_dirs():
+    # each parallel worker gets its own scratch directory so that extracted
+    # archives and ORT test dirs of different models do not collide
+    worker_dir = tempfile.mkdtemp(prefix=TEST_WORKER_PREFIX, dir=cwd_path)
+    return os.path.join(worker_dir, TEST_TAR_DIR), os.path.join(worker_dir, TEST_ORT_DIR)
 
 
-def remove_onnxruntime_test_dir():
-    if os.path.exists(TEST_ORT_DIR) and os.path.isdir(TEST_ORT_DIR):
-        rmtree(TEST_ORT_DIR)
+def remove_worker_dirs():
+    for entry in os.listdir(cwd_path):
+        worker_dir = os.path.join(cwd_path, entry)
+        if entry.startswith(TEST_WORKER_PREFIX) and os.path.isdir(worker_dir):
+            rmtree(worker_dir)
@@ -0,0 +1,201 @@
+# SPDX-License-Identifier: Apache-2.0
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+import sqlite3
+import yaml
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+STATS_FILE = "turnkey_stats.yaml"
+MODEL_DIRECTORIES = ["Computer_Vision", "Natural_Language_Processing", "Generative_AI", "Graph_Machine_Learning"]
+DEFAULT_DB = "turnkey_stats.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS models (
+    model_dir TEXT PRIMARY KEY,
+    mtime REAL NOT NULL,
+    task TEXT,
+    author TEXT,
+    model_name TEXT,
+    class_name TEXT,
+    opset INTEGER,
+    ir_version INTEGER,
+    size_kib REAL,
+    parameters INTEGER,
+    benchmark_status TEXT,
+    build_seconds REAL,
+    build_stages TEXT,
+    input_dimensions TEXT
+);
+CREATE TABLE IF NOT EXISTS ops (
+    model_dir TEXT NOT NULL,
+    op TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (model_dir, op)
+);
+CREATE INDEX IF NOT EXISTS ops_by_op ON ops (op, count);
+CREATE INDEX IF NOT EXISTS models_by_parameters ON models (parameters);
+"""
+
+MODEL_COLUMNS = ["model_dir", "mtime", "task", "author", "model_name", "class_name", "opset", "ir_version",
+                 "size_kib", "parameters", "benchmark_status", "build_seconds", "build_stages", "input_dimensions"]
+
+
+def find_stats_files(root="."):
+    """Return {model directory: mtime of its turnkey_stats.yaml} for all model directories under root."""
+    stats_files = {}
+    for directory in MODEL_DIRECTORIES:
+        category_dir = os.path.join(root, directory)
+        if not os.path.isdir(category_dir):
+            continue
+        for entry in os.scandir(category_dir):
+            stats_file = os.path.join(entry.path, STATS_FILE)
+            if entry.is_dir() and os.path.isfile(stats_file):
+                stats_files["/".join([directory, entry.name])] = os.path.getmtime(stats_file)
+    return stats_files
+
+
+def parse_stats_file(root, model_dir, mtime):
+    """Parse one turnkey_stats.yaml into a models row and its op counts. Runs in a worker process."""
+    with open(os.path.join(root, model_dir, STATS_FILE), "r") as f:
+        stats = yaml.load(f, Loader=SafeLoader)
+    model_info = stats.get("onnx_model_information") or {}
+    # models are built for a single target so far, use the first one
+    builds = stats.get("builds") or {}
+    build = next(iter(builds.values()), {})
+    build_stages = build.get("completed_build_stages") or {}
+    row = (
+        model_dir,
+        mtime,
+        stats.get("task"),
+        stats.get("author"),
+        stats.get("model_name"),
+        stats.get("class"),
+        model_info.get("opset"),
+        model_info.get("ir_version"),
+        model_info.get("size on disk (KiB)"),
+        stats.get("parameters"),
+        build.get("benchmark_status"),
+        sum(build_stages.values()),
+        json.dumps(build_stages),
+        json.dumps(stats.get("onnx_input_dimensions") or {}),
+    )
+    ops = [(model_dir, op, count) for op, count in (stats.get("onnx_ops_counter") or {}).items()]
+    return row, ops
+
+
+def build_index(root=".", db_path=DEFAULT_DB, jobs=None):
+    """Create or refresh the sqlite index of all turnkey_stats.yaml files under root.
+
+    Only files whose mtime changed since the last refresh are parsed again, on a pool of `jobs` processes.
+    Models whose directory was removed are dropped from the index.
+    :return: number of parsed files
+    """
+    stats_files = find_stats_files(root)
+    with sqlite3.connect(db_path) as conn:
+        conn.executescript(SCHEMA)
+        indexed = dict(conn.execute("SELECT model_dir, mtime FROM models"))
+        removed = [(model_dir,) for model_dir in indexed if model_dir not in stats_files]
+        changed = [model_dir for model_dir, mtime in stats_files.items() if indexed.get(model_dir) != mtime]
+
+        stale = removed + [(model_dir,) for model_dir in changed]
+        conn.executemany("DELETE FROM models WHERE model_dir = ?", stale)
+        conn.executemany("DELETE FROM ops WHERE model_dir = ?", stale)
+
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = executor.map(parse_stats_file, [root] * len(changed), changed,
+                                   [stats_files[model_dir] for model_dir in changed], chunksize=32)
+            for row, ops in results:
+                conn.execute("INSERT INTO models VALUES ({})".format(", ".join("?" * len(MODEL_COLUMNS))), row)
+                conn.executemany("INSERT INTO ops VALUES (?, ?, ?)", ops)
+    print(f"Indexed {len(changed)} changed and removed {len(removed)} of {len(stats_files)} models in {db_path}")
+    return len(changed)
+
+
+def query_models(db_path=DEFAULT_DB, task=None, opset=None, min_parameters=None, max_parameters=None,
+                 max_size_kib=None, benchmark_status=None, min_op_counts=None, max_op_counts=None):
+    """Return the indexed models matching all given filters as dicts, sorted by parameter count.
+
+    :param min_op_counts: Map of op type to the minimum number of such nodes a model must have.
+    :param max_op_counts: Map of op type to the maximum number of such nodes a model may have. Use 0 to
+                          exclude models using an op.
+    """
+    conditions = []
+    params = []
+    for column, operator, value in [("task", "=", task), ("opset", "=", opset),
+                                    ("parameters", ">=", min_parameters), ("parameters", "<=", max_parameters),
+                                    ("size_kib", "<=", max_size_kib), ("benchmark_status", "=", benchmark_status)]:
+        if value is not None:
+            conditions.append(f"{column} {operator} ?")
+            params.append(value)
+    op_count = "COALESCE((SELECT count FROM ops WHERE ops.model_dir = models.model_dir AND ops.op = ?), 0)"
+    for op, count in (min_op_counts or {}).items():
+        conditions.append(f"{op_count} >= ?")
+        params.extend([op, count])
+    for op, count in (max_op_counts or {}).items():
+        conditions.append(f"{op_count} <= ?")
+        params.extend([op, count])
+
+    sql = "SELECT * FROM models"
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    sql += " ORDER BY parameters, model_dir"
+    with sqlite3.connect(db_path) as conn:
+        conn.row_factory = sqlite3.Row
+        models = [dict(row) for row in conn.execute(sql, params)]
+    for model in models:
+        model["build_stages"] = json.loads(model["build_stages"])
+        model["input_dimensions"] = json.loads(model["input_dimensions"])
+    return models
+
+
+def parse_op_counts(values):
+    op_counts = {}
+    for value in values or []:
+        op, count = value.split("=")
+        op_counts[op] = int(count)
+    return op_counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Index and query turnkey_stats.yaml of all models")
+    parser.add_argument("--root", required=False, default=".", type=str,
+                        help="Repository root containing the model directories")
+    parser.add_argument("--db", required=False, default=DEFAULT_DB, type=str,
+                        help="sqlite file to store the index in")
+    parser.add_argument("--jobs", required=False, default=None, type=int,
+                        help="Number of processes to parse turnkey_stats.yaml with. Defaults to the number of CPUs")
+    parser.add_argument("--no_refresh", required=False, default=False, action="store_true",
+                        help="Query the existing index without refreshing it first")
+    parser.add_argument("--task", required=False, default=None, type=str,
+                        help="Only list models of this task, e.g. Computer_Vision")
+    parser.add_argument("--opset", required=False, default=None, type=int)
+    parser.add_argument("--min_parameters", required=False, default=None, type=int)
+    parser.add_argument("--max_parameters", required=False, default=None, type=int)
+    parser.add_argument("--max_size_kib", required=False, default=None, type=float)
+    parser.add_argument("--benchmark_status", required=False, default=None, type=str)
+    parser.add_argument("--min_op", required=False, default=None, action="append",
+                        help="OP=COUNT, only list models with at least COUNT nodes of OP. Can be repeated")
+    parser.add_argument("--max_op", required=False, default=None, action="append",
+                        help="OP=COUNT, only list models with at most COUNT nodes of OP. Can be repeated")
+    args = parser.parse_args()
+
+    if not args.no_refresh:
+        build_index(args.root, args.db, args.jobs)
+    models = query_models(args.db, args.task, args.opset, args.min_parameters, args.max_parameters,
+                          args.max_size_kib, args.benchmark_status, parse_op_counts(args.min_op),
+                          parse_op_counts(args.max_op))
+    for model in models:
+        print("{}\tparameters={}\topset={}\tsize_kib={}".format(model["model_dir"], model["parameters"],
+                                                                 model["opset"], model["size_kib"]))
+    print("Found {} models".format(len(models)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+# SPDX-License-Identifier: Apache-2.0
+
+import json
+import os
+import onnx
+import onnxruntime
+from test_utils import get_content_sha256
+
+
+class ValidationCache(object):
+    """Persistent record of models which passed validation.
+
+    An entry is keyed on the sha256 of the .onnx/.tar.gz content (which covers the test_data_set
+    inside a .tar.gz), the onnx and onnxruntime versions, the validation target and the output
+    tolerances, so any change of these re-validates the model.
+    """
+
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.entries = {}
+        if os.path.exists(cache_file):
+            with open(cache_file, "r") as f:
+                self.entries = json.load(f)
+
+    @staticmethod
+    def get_key(model_path, target, rtol, atol, tolerances=None):
+        """:param tolerances: The per-output tolerances of the model, see output_comparator.OutputComparator."""
+        return "|".join([get_content_sha256(model_path), onnx.__version__, onnxruntime.__version__, target,
+                         json.dumps([rtol, atol, tolerances or {}], sort_keys=True)])
+
+    def is_passed(self, key):
+        return key in self.entries
+
+    def record_pass(self, key, model_path):
+        self.entries[key] = model_path
+
+    def save(self):
+        tmp_file = self.cache_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(self.entries, f, indent=4, sort_keys=True)
+        os.replace(tmp_file, self.cache_file)